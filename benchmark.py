@@ -0,0 +1,288 @@
+# coding: utf-8
+# ORM 自身开销的离线基准测试，使用进程内的 MySQLdb 替身，不需要 MySQL
+#   python benchmark.py
+#   python benchmark.py --latency 0.2 --rows 5000 --output bench_output.txt
+#   python benchmark.py --json baseline.json                  # 保存结果
+#   python benchmark.py --compare baseline.json --tolerance 0.2  # ops/s 下降超过 20% 时退出码为 1
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+import types
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+# MySQLdb 替身：select 返回按列数生成的固定结果集，其余语句影响 1 行，可设置每条语句的模拟延迟
+class FakeDriver(object):
+    def __init__(self, rows=1000, latency=0.0):
+        self.rows = rows
+        self.latency = latency
+        self.statements = 0
+        self.last_id = 0
+        self.results = {}
+
+    def result(self, columns):
+        rows = self.results.get(columns)
+        if rows is None:
+            values = [lambda i: i, lambda i: 'name%d' % i, lambda i: i % 7, lambda i: i * 0.5]
+            rows = self.results[columns] = tuple(
+                tuple(values[column % len(values)](i) for column in range(columns)) for i in range(1, self.rows + 1))
+        return rows
+
+    def module(self):
+        driver = self
+
+        class Error(Exception):
+            pass
+
+        class DatabaseError(Error):
+            pass
+
+        class OperationalError(DatabaseError):
+            pass
+
+        class Cursor(object):
+            def __init__(self, conn):
+                self.conn = conn
+                self.rows = ()
+                self.index = 0
+                self.rowcount = -1
+                self.lastrowid = None
+
+            def execute(self, sql, params=None):
+                driver.statements += 1
+                if driver.latency:
+                    time.sleep(driver.latency / 1000.0)
+                lower = sql.lstrip()[:16].lower()
+                if lower.startswith('select count(*)'):
+                    self.rows = ((driver.rows,),)
+                elif lower.startswith('select 1 '):
+                    self.rows = ((1,),)
+                elif lower.startswith('select'):
+                    self.rows = driver.result(sql[:sql.lower().index(' from ')].count(',') + 1)
+                else:
+                    self.rows = ()
+                    driver.last_id += 1
+                    self.lastrowid = driver.last_id
+                    self.rowcount = 1
+                    return 1
+                self.index = 0
+                self.rowcount = len(self.rows)
+                return self.rowcount
+
+            def fetchall(self):
+                rows = self.rows[self.index:]
+                self.index = len(self.rows)
+                return rows
+
+            def fetchone(self):
+                if self.index >= len(self.rows):
+                    return None
+                self.index += 1
+                return self.rows[self.index - 1]
+
+            def fetchmany(self, size=1):
+                rows = self.rows[self.index:self.index + size]
+                self.index += len(rows)
+                return rows
+
+            def close(self):
+                pass
+
+        class SSCursor(Cursor):
+            pass
+
+        class Connection(object):
+            def __init__(self, **kwargs):
+                self.open = True
+
+            def autocommit(self, flag):
+                pass
+
+            def cursor(self, cursorclass=None):
+                return (cursorclass or Cursor)(self)
+
+            def ping(self, *args):
+                pass
+
+            def commit(self):
+                pass
+
+            def rollback(self):
+                pass
+
+            def close(self):
+                self.open = False
+
+        cursors = types.ModuleType('MySQLdb.cursors')
+        cursors.Cursor = Cursor
+        cursors.SSCursor = SSCursor
+        module = types.ModuleType('MySQLdb')
+        module.Error = Error
+        module.DatabaseError = DatabaseError
+        module.OperationalError = OperationalError
+        module.IntegrityError = module.ProgrammingError = DatabaseError
+        module.connect = Connection
+        module.cursors = cursors
+        return module, cursors
+
+
+# 重复调用 func 至少 min_time 秒，取三次中最快的一次；另用 tracemalloc 测每次调用的内存峰值
+def measure(name, func, driver, min_time, ops=1):
+    func()
+    loops = 1
+    while True:
+        start = timer()
+        for _ in range(loops):
+            func()
+        elapsed = timer() - start
+        if elapsed >= min_time:
+            break
+        loops = loops * 2 if elapsed <= 0 else max(loops * 2, int(loops * min_time / elapsed * 1.1))
+
+    best = elapsed
+    statements = driver.statements
+    for _ in range(2):
+        start = timer()
+        for _ in range(loops):
+            func()
+        best = min(best, timer() - start)
+    statements = (driver.statements - statements) / 2.0 / loops
+
+    tracemalloc.start()
+    current, _ = tracemalloc.get_traced_memory()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'name': name,
+        'ops_per_sec': loops * ops / best,
+        'usec_per_op': best / loops / ops * 1e6,
+        'peak_bytes_per_call': peak - current,
+        'statements_per_call': statements,
+    }
+
+
+def build_benchmarks(data_handler, rows):
+    Q = data_handler.Q
+    Model = data_handler.Model
+    Field = data_handler.Field
+
+    class BenchModel(Model):
+        __db_table__ = 'bench'
+        __db_label__ = 'bench'
+        id = Field(primary_key=True)
+        name = Field()
+        score = Field()
+        weight = Field()
+
+    objects = BenchModel.objects
+    q_tree = (Q(name='a') | Q(score__gt=3)) & ~Q(id__in=[1, 2, 3]) & Q(weight__range=(1, 5))
+    queryset = objects.filter(q_tree, name__startswith='n').exclude(score=0).order_by('-id')[10:20]
+    query = queryset.query
+    loaded = objects.first()
+
+    def save_changed():
+        loaded.score += 1
+        loaded.save()
+
+    def to_numpy():
+        return objects.values_list('id', 'score', 'weight').to_numpy(chunk_size=500)
+
+    def uncached_query():
+        data_handler.Query.sql_cache.clear()
+        return query.sql_expr()
+
+    return [
+        # sql 编译
+        ('Q._sql_expr', lambda: q_tree._sql_expr(), 1),
+        ('Q.sql_expr', lambda: q_tree.sql_expr(), 1),
+        ('Query.sql_expr (cached)', lambda: query.sql_expr(), 1),
+        ('Query.sql_expr (uncached)', uncached_query, 1),
+        ('Query._sql_expr', lambda: query._sql_expr(), 1),
+        # QuerySet 复制
+        ('QuerySet._clone', lambda: queryset._clone(), 1),
+        ('filter().exclude().order_by()[:10]', lambda: objects.filter(name='a').exclude(score=1).order_by('-id')[:10], 1),
+        # 结果行转换
+        ('__iter__ models/row', lambda: list(objects.all()), rows),
+        ('ValuesQuerySet dicts/row', lambda: list(objects.values()), rows),
+        ('ValuesListQuerySet tuples/row', lambda: list(objects.values_list('id', 'name')), rows),
+        ('ValuesListQuerySet flat/row', lambda: list(objects.all().values_list('id', flat=True)), rows),
+        ('iterator() models/row', lambda: list(objects.all().iterator(chunk_size=500)), rows),
+        ('to_columns() 3 columns/row', lambda: objects.values_list('id', 'score', 'weight').to_columns(chunk_size=500), rows),
+        ('to_numpy() 3 columns/row', to_numpy if data_handler.numpy is not None else None, rows),
+        ('count()', lambda: objects.filter(score=1).count(), 1),
+        ('filter(pk=).first()', lambda: objects.filter(pk=1).first(), 1),
+        # 保存及其语句数
+        ('save() new', lambda: BenchModel(name='x', score=1, weight=0.5).save(), 1),
+        ('save() loaded, unchanged', lambda: loaded.save(), 1),
+        ('save() loaded, one field changed', save_changed, 1),
+        ('create()', lambda: objects.create(name='x', score=1), 1),
+        ('bulk_create() 1000 rows/row', lambda: objects.bulk_create([BenchModel(name='x', score=i) for i in range(1000)]),
+         1000),
+        ('filter().update()', lambda: objects.filter(score=1).update(name='y'), 1),
+    ]
+
+
+def format_results(results, baseline=None):
+    lines = ['%-36s %14s %12s %14s %10s' % ('benchmark', 'ops/s', 'usec/op', 'peak B/call', 'stmts')]
+    for result in results:
+        line = '%-36s %14.0f %12.3f %14d %10.2f' % (
+            result['name'], result['ops_per_sec'], result['usec_per_op'],
+            result['peak_bytes_per_call'], result['statements_per_call'])
+        if baseline and result['name'] in baseline:
+            line += '  %+.1f%%' % ((result['ops_per_sec'] / baseline[result['name']]['ops_per_sec'] - 1) * 100)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmark of the ORM overhead with a fake MySQLdb driver.')
+    parser.add_argument('--rows', type=int, default=1000, help='rows returned by every select')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated latency per statement, in ms')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per timing run')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('--output', help='also write the report to this file')
+    parser.add_argument('--json', help='write the results as json to this file')
+    parser.add_argument('--compare', help='json results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed ops/s drop when comparing')
+    args = parser.parse_args(argv)
+
+    driver = FakeDriver(rows=args.rows, latency=args.latency)
+    sys.modules['MySQLdb'], sys.modules['MySQLdb.cursors'] = driver.module()
+    sys.modules.pop('data_handler', None)
+    import data_handler
+    data_handler.Database.connect(bench={'min_size': 1, 'max_size': 4})
+
+    results = []
+    for name, func, ops in build_benchmarks(data_handler, args.rows):
+        if func is not None and args.filter in name:
+            results.append(measure(name, func, driver, args.min_time, ops))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = dict((result['name'], result) for result in json.load(f))
+    report = format_results(results, baseline)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline:
+        regressions = [result['name'] for result in results if result['name'] in baseline and
+                       result['ops_per_sec'] < baseline[result['name']]['ops_per_sec'] * (1 - args.tolerance)]
+        if regressions:
+            print('regressed: ' + ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,335 @@
 # coding: utf-8
+import array
+import base64
+import bisect
+import collections
+import datetime
+import decimal
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import operator
+import pickle
+import threading
+import time
+import zlib
+
 import MySQLdb
+import MySQLdb.cursors
 # py2 mysql-python  py3 mysqlclient
 
+try:
+    from itertools import imap
+except ImportError:
+    imap = map
+
+# 可选依赖，to_numpy() 使用
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# to_columns() 整数列使用的 array typecode，py2 的 array 没有 'q'
+INT_TYPECODE = 'q' if 'q' in getattr(array, 'typecodes', '') else 'l'
+try:
+    INT_TYPES = {int, long, bool}
+except NameError:
+    INT_TYPES = {int, bool}
+
+# 计时，py2 没有 perf_counter
+timer = getattr(time, 'perf_counter', time.time)
+
 
 class Field():
     def __init__(self, **kw):
         self.primary_key = kw.get('primary_key', False)
 
 
+class ObjectDoesNotExist(Exception):
+    pass
+
+
+class MultipleObjectsReturned(Exception):
+    pass
+
+
+# 一次工作单元内，相同 (model, pk) 的查询结果返回同一实例，嵌套使用时共用最外层
+class IdentityMap(object):
+    local = threading.local()
+
+    def __init__(self):
+        self.objs = {}
+        self.depth = 0
+
+    @classmethod
+    def current(cls):
+        return getattr(cls.local, 'identity_map', None)
+
+    def __enter__(self):
+        scope = self.current()
+        if scope is None:
+            scope = self.local.identity_map = self
+        scope.depth += 1
+        return scope
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        scope = self.current()
+        scope.depth -= 1
+        if not scope.depth:
+            scope.objs.clear()
+            self.local.identity_map = None
+
+    def get(self, model, pk):
+        return self.objs.get((model, pk))
+
+    def add(self, inst):
+        pk = inst.pk
+        if pk is not None:
+            self.objs[(inst.__class__, pk)] = inst
+
+    # update/delete 后该模型已加载的实例可能过期
+    def discard_model(self, model):
+        for key in [key for key in self.objs if key[0] is model]:
+            del self.objs[key]
+
+    # 包装结果行构造函数，已加载的主键直接返回已有实例
+    def wrap(self, model, fields, factory):
+        primary_key = model.__primary_key__
+        if not primary_key or primary_key not in fields:
+            return factory
+        pk_index = list(fields).index(primary_key)
+        objs = self.objs
+
+        def identity_factory(row):
+            key = (model, row[pk_index])
+            inst = objs.get(key)
+            if inst is None:
+                inst = objs[key] = factory(row)
+            return inst
+        return identity_factory
+
+
+# 只有 offset 时使用的 limit，mysql 文档中的写法
+MAX_LIMIT = 18446744073709551615
+
+# MySQL 5.7 默认的 max_allowed_packet
+DEFAULT_MAX_ALLOWED_PACKET = 4 * 1024 * 1024
+
+# in 查询超过 in_chunk_size 个值时分块执行，超过 in_temp_table_threshold 个值时使用临时表
+DEFAULT_IN_CHUNK_SIZE = 5000
+DEFAULT_IN_TEMP_TABLE_THRESHOLD = 50000
+# 分块时为 in 列表以外的部分预留的语句字节数
+IN_CHUNK_RESERVED_BYTES = 64 * 1024
+
+
+# 大 in 查询的值，去重并保持顺序
+def unique_values(values):
+    values = tuple(values)
+    try:
+        if len(set(values)) != len(values):
+            values = tuple(collections.OrderedDict.fromkeys(values))
+    except TypeError:
+        pass
+    return values
+
+
+# 估算参数转义后在sql中所占字节数
+def estimate_literal_size(value):
+    if value is None:
+        return 4
+    if isinstance(value, (bytes, bytearray)):
+        return len(value) * 2 + 2
+    if isinstance(value, (int, float)):
+        return len(str(value))
+    return len((u'%s' % value).encode('utf-8')) * 2 + 2
+
+
+if hasattr(collections.OrderedDict, 'move_to_end'):
+    move_to_end = collections.OrderedDict.move_to_end
+else:
+    def move_to_end(ordered_dict, key):
+        ordered_dict[key] = ordered_dict.pop(key)
+
+
+# 线程安全的 LRU 缓存，记录命中及未命中次数
+class LRUCache(object):
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            move_to_end(self.data, key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+
+# 查询结果缓存后端，key 中包含表的版本号，表数据变更时增加版本号使旧结果失效
+class BaseCache(object):
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def get_version(self, table_key):
+        raise NotImplementedError
+
+    def incr_version(self, table_key):
+        raise NotImplementedError
+
+
+# 进程内缓存，超过 max_size 时淘汰最久未使用的结果
+class LocalCache(BaseCache):
+    def __init__(self, max_size=1024):
+        self.entries = LRUCache(max_size)
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expire_at, value = entry
+        if expire_at is not None and expire_at < time.time():
+            self.entries.pop(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        expire_at = None if ttl is None else time.time() + ttl
+        self.entries.set(key, (expire_at, value))
+
+    def get_version(self, table_key):
+        return self.versions.get(table_key, 0)
+
+    def incr_version(self, table_key):
+        with self.lock:
+            self.versions[table_key] = self.versions.get(table_key, 0) + 1
+
+
+# memcached 缓存，client 为 pymemcache、python-memcached 等提供 get/set/add/incr 的客户端
+class MemcachedCache(BaseCache):
+    def __init__(self, client, prefix='orm'):
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, key):
+        return '%s:%s' % (self.prefix, hashlib.md5(repr(key).encode('utf-8')).hexdigest())
+
+    def _version_key(self, table_key):
+        return '%s:version:%s.%s' % ((self.prefix,) + tuple(table_key))
+
+    def get(self, key):
+        data = self.client.get(self._key(key))
+        if data is None:
+            return None
+        return pickle.loads(data)
+
+    def set(self, key, value, ttl):
+        self.client.set(self._key(key), pickle.dumps(value, 2), int(ttl or 0))
+
+    def get_version(self, table_key):
+        version = self.client.get(self._version_key(table_key))
+        return int(version) if version else 0
+
+    def incr_version(self, table_key):
+        version_key = self._version_key(table_key)
+        if self.client.incr(version_key, 1) is None:
+            self.client.add(version_key, '1', 0)
+
+
+# 模型的结果缓存配置，__cache__ 为缓存秒数或 {'ttl': 60, 'backend': LocalCache()}
+class ResultCache(object):
+    default_backend = None
+    # (db_label, db_table) -> 使用该表的 ResultCache 列表，用于写入时失效
+    registry = {}
+
+    def __init__(self, db_label, db_table, config):
+        if not isinstance(config, dict):
+            config = {'ttl': config}
+        self.table_key = (db_label, db_table)
+        self.ttl = config.get('ttl', 60)
+        self.backend = config.get('backend')
+        self.registry.setdefault(self.table_key, []).append(self)
+
+    def get_backend(self):
+        if self.backend is not None:
+            return self.backend
+        if ResultCache.default_backend is None:
+            ResultCache.default_backend = LocalCache()
+        return ResultCache.default_backend
+
+    # 查询缓存，未命中时执行并用 fetch 取得结果后写入缓存
+    def fetch(self, sql, params, fetch, queryset=None):
+        backend = self.get_backend()
+        key = (self.table_key, backend.get_version(self.table_key), sql, params)
+        value = backend.get(key)
+        if value is None:
+            value = fetch(Database.execute(self.table_key[0], sql, params, readonly=True, queryset=queryset))
+            backend.set(key, value, self.ttl)
+        return value
+
+    def invalidate(self):
+        self.get_backend().incr_version(self.table_key)
+
+
+# 表数据变更后使该表的结果缓存失效，执行原生sql修改数据后也可手动调用
+def invalidate_cache(db_label, db_table):
+    result_caches = ResultCache.registry.get((db_label, db_table))
+    if not result_caches:
+        return
+    transaction = Database.get_transaction(db_label)
+    if transaction is not None:
+        transaction.dirty_tables.add(db_table)
+    for result_cache in result_caches:
+        result_cache.invalidate()
+
+
+# 双下划线查询对应的sql
+LOOKUP_SQL = {
+    '': ' = %s ',
+    'gt': ' > %s ',
+    'gte': ' >= %s ',
+    'lt': ' < %s ',
+    'lte': ' <= %s ',
+    'contains': ' like %%%s%% ',
+    'startswith': ' like %s%% ',
+    'endswith': ' like %%%s ',
+}
+
+
 class Q():
     def __init__(self, *args, **kwargs):
         self.children = list(args) + list(kwargs.items())
@@ -79,19 +401,60 @@ class Q():
         sql_list, params = self._sql_expr()
         return self.connector.join(sql_list), params
 
+    # 查询结构（不含参数值）及参数，遍历方式与 _sql_expr 一致，结构相同则生成的sql相同
+    def shape_params(self):
+        shape = [self.connector, self.negated]
+        params = []
+        for child in self.children:
+            if isinstance(child, Q):
+                temp_shape, temp_params = child.shape_params()
+                if temp_params:
+                    shape.append(temp_shape)
+                    params.extend(temp_params)
+            elif '__' not in child[0]:
+                # 等值查询
+                shape.append(child[0])
+                params.append(child[1])
+            else:
+                temp_shape, temp_params = self.magic_shape(child)
+                shape.append(temp_shape)
+                params.extend(temp_params)
+        return tuple(shape), params
+
+    # 双下划线查询的结构及参数，与 magic_query 对应
+    def magic_shape(self, child_query):
+        query_str, value = child_query
+        _, magic = query_str.split('__')
+        if magic in LOOKUP_SQL:
+            return query_str, [value]
+        elif magic == 'isnull':
+            return (query_str, bool(value)), []
+        elif magic == 'range':
+            return query_str, list(value)
+        elif magic == 'in':
+            if isinstance(value, (ValuesListQuerySet, ValuesQuerySet)):
+                if len(value.query.select) != 1:
+                    raise TypeError('Cannot use a multi-field %s as a filter value.'
+                                    % value.__class__.__name__)
+                sub_shape, sub_params = value.query.shape_params()
+                return (query_str, sub_shape), sub_params
+            elif isinstance(value, QuerySet):
+                primary_key = value.model.__primary_key__
+                if not primary_key:
+                    raise TypeError('Primary key not defined in class: %s' % value.model.__class__.__name__)
+                subquery = value.query.clone()
+                subquery.select = [primary_key]
+                sub_shape, sub_params = subquery.shape_params()
+                return (query_str, sub_shape), sub_params
+            elif isinstance(value, InTempTable):
+                return (query_str, 'temp', value.name), []
+            elif len(value) == 0:
+                return (query_str, 'empty'), []
+            return (query_str, 'list'), [tuple(value)]
+        return (query_str, 'unknown'), []
+
     # 处理双下划线特殊查询
     def magic_query(self, child_query):
-        correspond_dict = {
-            '': ' = %s ',
-            'gt': ' > %s ',
-            'gte': ' >= %s ',
-            'lt': ' < %s ',
-            'lte': ' <= %s ',
-            'contains': ' like %%%s%% ',
-            'startswith': ' like %s%% ',
-            'endswith': ' like %%%s ',
-        }
-
         raw_sql = ''
         params = []
         query_str, value = child_query
@@ -100,7 +463,7 @@ class Q():
         else:
             field = query_str
             magic = ''
-        temp_sql = correspond_dict.get(magic)
+        temp_sql = LOOKUP_SQL.get(magic)
         if temp_sql:
             raw_sql = ' ' + field + temp_sql
             params = [value]
@@ -130,6 +493,8 @@ class Q():
                 sub_sql, sub_params = subquery.sql_expr()
                 raw_sql = ' ' + field + ' in ( ' + sub_sql[:-1] + ' ) '
                 params = sub_params
+            elif isinstance(value, InTempTable):
+                raw_sql = ' ' + field + ' in ( select value from ' + value.name + ' ) '
             else:
                 if len(value) == 0:
                     raw_sql = ' False '
@@ -140,6 +505,43 @@ class Q():
 
         return raw_sql, params
 
+    # 超过 size 个值的 in 条件（不含子查询），按遍历顺序
+    def large_in(self, size):
+        result = []
+        for child in self.children:
+            if isinstance(child, Q):
+                result.extend(child.large_in(size))
+            elif is_large_in(child, size):
+                result.append(child)
+        return result
+
+    # 将超过 size 个值的 in 条件的值替换为 replace(field, values) 的返回值，没有替换时返回自身
+    def replace_large_in(self, size, replace):
+        children = []
+        changed = False
+        for child in self.children:
+            if isinstance(child, Q):
+                new_child = child.replace_large_in(size, replace)
+            elif is_large_in(child, size):
+                new_child = (child[0], replace(child[0][:-4], child[1]))
+            else:
+                new_child = child
+            changed = changed or new_child is not child
+            children.append(new_child)
+        if not changed:
+            return self
+        obj = self.clone()
+        obj.children = children
+        return obj
+
+    # clone，add 只会修改当前节点的 children，复制一层即可
+    def clone(self):
+        obj = Q()
+        obj.connector = self.connector
+        obj.negated = self.negated
+        obj.children = self.children[:]
+        return obj
+
     def __len__(self):
         return len(self.children)
 
@@ -157,7 +559,123 @@ class Q():
                                                         self.children]))
 
 
+def is_large_in(child, size):
+    query_str, value = child
+    return (query_str.endswith('__in') and not isinstance(value, (QuerySet, InTempTable)) and
+            len(value) > size)
+
+
+# case 表达式: case field when v1 then r1 ... else default end，default 为字段名
+class Case():
+    def __init__(self, field, whens, default=None):
+        self.field = field
+        self.whens = whens
+        self.default = default
+
+    def sql_expr(self):
+        sql_list = ['case ' + self.field]
+        params = []
+        for when, then in self.whens:
+            sql_list.append(' when %s then %s')
+            params.extend([when, then])
+        if self.default:
+            sql_list.append(' else ' + self.default)
+        sql_list.append(' end')
+        return ''.join(sql_list), params
+
+    def shape_params(self):
+        params = []
+        for when, then in self.whens:
+            params.extend([when, then])
+        return ('case', self.field, len(self.whens), self.default), params
+
+
+# 写入临时表的 in 查询的值，查询中为 field in (select value from 临时表)
+# 表名按查询中的顺序编号，临时表只在当前连接可见，同一连接上用完即删除
+class InTempTable(object):
+    def __init__(self, name, values):
+        self.name = name
+        self.values = values
+
+    # 按 max_allowed_packet 分批写入，value 列的类型与 field 相同
+    def create(self, queryset, db_label, field):
+        db_table = queryset.model.__db_table__
+        Database.execute(db_label, 'create temporary table %s (primary key (value)) select %s as value from %s limit 0;'
+                         % (self.name, field, db_table), queryset=queryset)
+        base_size = len(self.name) + 32
+        for batch in queryset._split_batches(db_label, self.values, None, base_size,
+                                             lambda value: estimate_literal_size(value) + 4):
+            Database.execute(db_label, 'insert ignore into %s (value) values %s;'
+                             % (self.name, ', '.join(['(%s)'] * len(batch))), batch, queryset=queryset)
+
+    def drop(self, queryset, db_label):
+        Database.execute(db_label, 'drop temporary table if exists %s;' % self.name, queryset=queryset)
+
+
+# 聚合函数，Count 的 field 可为 '*'
+class Aggregate(object):
+    function = None
+
+    def __init__(self, field, distinct=False):
+        self.field = field
+        self.distinct = distinct
+
+    def sql_expr(self):
+        return '%s(%s%s)' % (self.function, 'distinct ' if self.distinct else '', self.field)
+
+    def shape(self):
+        return self.function, self.field, self.distinct
+
+    # 未指定别名时使用，别名中不能有双下划线以免与查询后缀混淆
+    def default_alias(self):
+        if self.field == '*':
+            return self.function
+        return '%s_%s' % (self.field, self.function)
+
+    # 合并各分片的聚合结果
+    def merge(self, values):
+        raise TypeError('Cannot merge %s across shards.' % self.__class__.__name__)
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.sql_expr())
+
+
+class Sum(Aggregate):
+    function = 'sum'
+
+    def merge(self, values):
+        return sum(values)
+
+
+class Count(Aggregate):
+    function = 'count'
+
+    def merge(self, values):
+        return sum(values)
+
+
+class Avg(Aggregate):
+    function = 'avg'
+
+
+class Max(Aggregate):
+    function = 'max'
+
+    def merge(self, values):
+        return max(values)
+
+
+class Min(Aggregate):
+    function = 'min'
+
+    def merge(self, values):
+        return min(values)
+
+
 class Query():
+    # 已编译sql的缓存，key 为查询结构，参数每次重新构建
+    sql_cache = LRUCache(1024)
+
     def __init__(self, model):
         self.model = model
         self.fields_list = self.model.field_list
@@ -168,13 +686,83 @@ class Query():
         self.limit_dict = {}
         self.order_fields = []
         self.select = self.fields_list
+        # 别名 -> 聚合函数，别名同时出现在 select 中；有聚合时按 select 中的其余字段分组
+        # having_Q 在 annotate 时创建
+        self.annotations = {}
+        self.having_Q = None
 
     def __str__(self):
         sql, params = self.sql_expr()
         return sql % params
 
-    # 根据当前筛选条件构建sql、params
+    # 根据当前筛选条件构建sql、params，结构相同的查询直接使用缓存的sql
     def sql_expr(self, method='select', update_dict=None):
+        if update_dict and self.limit_dict:
+            # 不支持切片更新
+            raise TypeError('Cannot update a query once a slice has been taken.')
+        if self.annotations and method in ('update', 'delete'):
+            raise TypeError('Cannot %s an annotated query.' % method)
+        key, params = self.shape_params(method, update_dict)
+        sql = self.sql_cache.get(key)
+        if sql is None:
+            sql, _ = self._sql_expr(method, update_dict)
+            self.sql_cache.set(key, sql)
+        return sql, tuple(params)
+
+    # 查询结构及参数，参数顺序与 _sql_expr 一致
+    def shape_params(self, method='select', update_dict=None):
+        params = []
+        update_shape = None
+        if method == 'update' and update_dict:
+            update_shape = []
+            for key, val in update_dict.items():
+                if key not in self.fields_list:
+                    continue
+                if isinstance(val, Case):
+                    case_shape, case_params = val.shape_params()
+                    update_shape.append((key, case_shape))
+                    params.extend(case_params)
+                else:
+                    update_shape.append(key)
+                    params.append(val)
+            update_shape = tuple(update_shape)
+
+        filter_shape = None
+        if self.filter_Q:
+            filter_shape, temp_params = self.filter_Q.shape_params()
+            params.extend(temp_params)
+        exclude_shape = None
+        if self.exclude_Q:
+            exclude_shape, temp_params = self.exclude_Q.shape_params()
+            params.extend(temp_params)
+        annotation_shape = None
+        having_shape = None
+        if self.annotations:
+            annotation_shape = tuple((alias, aggregate.shape()) for alias, aggregate in self.annotations.items())
+            if self.having_Q:
+                having_shape, temp_params = self.having_Q.shape_params()
+                params.extend(temp_params)
+
+        limit = self.limit_dict.get('limit')
+        offset = self.limit_dict.get('offset')
+        if limit is not None and method != 'exists':
+            params.append(limit)
+        if offset is not None:
+            params.append(offset)
+
+        key = (self.model, method, update_shape, filter_shape, exclude_shape, annotation_shape, having_shape,
+               tuple(self.select), tuple(self.order_fields), limit is not None, offset is not None)
+        return key, params
+
+    # select 的字段，聚合别名替换为 "聚合函数 as 别名"
+    def select_expr(self):
+        if not self.annotations:
+            return ', '.join(self.select)
+        return ', '.join([self.annotations[field].sql_expr() + ' as ' + field if field in self.annotations else field
+                          for field in self.select])
+
+    # 构建sql、params
+    def _sql_expr(self, method='select', update_dict=None):
         params = []
         where_expr = ''
 
@@ -188,13 +776,24 @@ class Query():
 
         if self.exclude_Q:
             temp_sql, temp_params = self.exclude_Q.sql_expr()
-            if params:
+            if self.filter_Q:
                 where_expr += ' and '
             where_expr += ' not (' + temp_sql + ')'
             params.extend(temp_params)
 
+        # 聚合查询的 group by 及 having
+        if self.annotations:
+            group_fields = [field for field in self.select if field not in self.annotations]
+            if group_fields:
+                where_expr += ' group by ' + ', '.join(group_fields)
+            if self.having_Q:
+                temp_sql, temp_params = self.having_Q.sql_expr()
+                where_expr += ' having (' + temp_sql + ')'
+                params.extend(temp_params)
+
+        order_expr = ''
         if self.order_fields:
-            where_expr += ' order by '
+            order_expr += ' order by '
             order_list = []
             for field in self.order_fields:
                 if field[0] == '-':
@@ -202,59 +801,204 @@ class Query():
                     order_list.append(field_name + ' desc ')
                 else:
                     order_list.append(field)
-            where_expr += ' , '.join(order_list)
-
-        if update_dict and self.limit_dict:
-            # 不支持切片更新
-            raise TypeError('Cannot update a query once a slice has been taken.')
+            order_expr += ' , '.join(order_list)
 
-        # limit
+        # limit，exists 只取一行
+        limit_expr = ''
         limit = self.limit_dict.get('limit')
-        if limit is not None:
-            where_expr += ' limit %s '
-            params.append(limit)
         offset = self.limit_dict.get('offset')
+        if method == 'exists':
+            limit_expr += ' limit 1 '
+        elif limit is not None:
+            limit_expr += ' limit %s '
+            params.append(limit)
+        elif offset is not None:
+            # mysql 的 offset 必须搭配 limit
+            limit_expr += ' limit %s ' % MAX_LIMIT
         if offset is not None:
-            where_expr += ' offset %s '
+            limit_expr += ' offset %s '
             params.append(offset)
 
         # 构建不同操作的sql语句
         if method == 'count':
-            sql = 'select count(*) from %s %s;' % (self.model.__db_table__, where_expr)
+            if self.annotations:
+                # 分组后的数量
+                sql = 'select count(*) from (select %s from %s %s %s) t;' % (
+                    self.select_expr(), self.model.__db_table__, where_expr, limit_expr)
+            elif self.limit_dict:
+                # 切片后的数量，在子查询中完成 limit/offset
+                sql = 'select count(*) from (select 1 from %s %s %s) t;' % (
+                    self.model.__db_table__, where_expr, limit_expr)
+            else:
+                sql = 'select count(*) from %s %s;' % (self.model.__db_table__, where_expr)
+        elif method == 'exists':
+            if self.annotations:
+                # having 中的聚合别名需在分组查询的 select 中
+                sql = 'select 1 from (select %s from %s %s) t %s;' % (
+                    self.select_expr(), self.model.__db_table__, where_expr, limit_expr)
+            else:
+                sql = 'select 1 from %s %s %s;' % (self.model.__db_table__, where_expr, limit_expr)
         elif method == 'update' and update_dict:
-            _keys = []
+            _sets = []
             _params = []
             for key, val in update_dict.items():
                 if key not in self.fields_list:
                     continue
-                _keys.append(key)
-                _params.append(val)
+                if isinstance(val, Case):
+                    case_sql, case_params = val.sql_expr()
+                    _sets.append(key + ' = ' + case_sql)
+                    _params.extend(case_params)
+                else:
+                    _sets.append(key + ' = %s')
+                    _params.append(val)
             params = _params + params
-            sql = 'update %s set %s %s;' % (
-                self.model.__db_table__, ', '.join([key + ' = %s' for key in _keys]), where_expr)
+            sql = 'update %s set %s %s %s %s;' % (
+                self.model.__db_table__, ', '.join(_sets), where_expr, order_expr, limit_expr)
         elif method == 'delete':
-            sql = 'delete from %s %s;' % (self.model.__db_table__, where_expr)
+            sql = 'delete from %s %s %s %s;' % (self.model.__db_table__, where_expr, order_expr, limit_expr)
         else:
-            sql = 'select %s from %s %s;' % (', '.join(self.select), self.model.__db_table__, where_expr)
+            sql = 'select %s from %s %s %s %s;' % (
+                self.select_expr(), self.model.__db_table__, where_expr, order_expr, limit_expr)
         return sql, tuple(params)
 
     # clone
     def clone(self):
         obj = Query(self.model)
-        obj.filter_Q = self.filter_Q
-        obj.exclude_Q = self.exclude_Q
+        obj.filter_Q = self.filter_Q.clone()
+        obj.exclude_Q = self.exclude_Q.clone()
         obj.order_fields = self.order_fields[:]
         obj.limit_dict.update(self.limit_dict)
         obj.select = self.select[:]
+        obj.flat = self.flat
+        if self.annotations:
+            obj.annotations = self.annotations.copy()
+            if self.having_Q is not None:
+                obj.having_Q = self.having_Q.clone()
         return obj
 
 
+# 连接归还前从 cursor 取出的结果，提供 cursor 的读取接口
+# cursor 在归还前关闭，其 close()/__del__ 不会在连接被其他线程使用时访问连接
+class CursorResult(object):
+    __slots__ = ('rows', 'index', 'rowcount', 'lastrowid', 'description')
+
+    def __init__(self, cursor):
+        self.rows = cursor.fetchall()
+        self.index = 0
+        self.rowcount = cursor.rowcount
+        self.lastrowid = cursor.lastrowid
+        self.description = getattr(cursor, 'description', None)
+
+    def fetchall(self):
+        rows = self.rows[self.index:]
+        self.index = len(self.rows)
+        return rows
+
+    def fetchone(self):
+        if self.index >= len(self.rows):
+            return None
+        self.index += 1
+        return self.rows[self.index - 1]
+
+    def fetchmany(self, size=1):
+        rows = self.rows[self.index:self.index + size]
+        self.index += len(rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+
+# 从 cursor 取得结果
+fetch_all = operator.methodcaller('fetchall')
+fetch_one = operator.methodcaller('fetchone')
+
+
+def fetch_exists(cursor):
+    return cursor.fetchone() is not None
+
+
+# 键集分页的翻页 token：排序字段及上一页最后一行的排序值，json 后 base64 编码
+def encode_page_token(order_fields, values):
+    encoded = []
+    for value in values:
+        if isinstance(value, datetime.datetime):
+            value = ['datetime', value.strftime('%Y-%m-%d %H:%M:%S.%f')]
+        elif isinstance(value, datetime.date):
+            value = ['date', value.strftime('%Y-%m-%d')]
+        elif isinstance(value, decimal.Decimal):
+            value = ['decimal', str(value)]
+        encoded.append(value)
+    data = json.dumps([list(order_fields), encoded], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+# token 由客户端传回，格式或值不正确时抛出 TypeError
+def decode_page_token(token, order_fields):
+    try:
+        token = str(token)
+        data = base64.urlsafe_b64decode((token + '=' * (-len(token) % 4)).encode('ascii'))
+        token_fields, encoded = json.loads(data.decode('utf-8'))
+        if not isinstance(encoded, list):
+            raise TypeError
+    except (TypeError, ValueError):
+        raise TypeError('Invalid page token.')
+    if token_fields != list(order_fields) or len(encoded) != len(order_fields):
+        raise TypeError('Page token does not match the ordering of this query.')
+    try:
+        return [decode_token_value(value) for value in encoded]
+    except (TypeError, ValueError, decimal.InvalidOperation):
+        raise TypeError('Invalid page token.')
+
+
+def decode_token_value(value):
+    if isinstance(value, dict):
+        raise TypeError(value)
+    if not isinstance(value, list):
+        return value
+    kind, value = value
+    if kind == 'datetime':
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    if kind == 'date':
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    if kind == 'decimal':
+        return decimal.Decimal(value)
+    raise TypeError(kind)
+
+
+# 键集分页的一页结果，next_token 为下一页的 token，最后一页为 None
+class Page(object):
+    def __init__(self, object_list, next_token):
+        self.object_list = object_list
+        self.next_token = next_token
+
+    @property
+    def has_next(self):
+        return self.next_token is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __repr__(self):
+        return '<Page Obj>'
+
+
 class QuerySet(object):
     def __init__(self, model, query=None):
         self.model = model
         self.select_result = None
         self.query = query or Query(model)
         self.fields_list = self.model.field_list
+        self.db_label = None
 
     # all函数，返回一个新的QuerySet对象（无筛选条件）
     def all(self):
@@ -275,38 +1019,450 @@ class QuerySet(object):
         except IndexError:
             return None
 
-    # count
+    # get，结果必须只有一条；IdentityMap 中已加载的主键直接返回
+    def get(self, *args, **kwargs):
+        scope = IdentityMap.current()
+        if scope is not None and not args and len(kwargs) == 1 and self._is_unfiltered():
+            (key, value), = kwargs.items()
+            if key in ('pk', self.model.__primary_key__):
+                inst = scope.get(self.model, value)
+                if inst is not None:
+                    return inst
+
+        clone = self.filter(*args, **kwargs) if args or kwargs else self._clone()
+        result = list(clone[:2])
+        if not result:
+            raise self.model.DoesNotExist('%s matching query does not exist.' % self.model.__name__)
+        if len(result) > 1:
+            raise self.model.MultipleObjectsReturned('get() returned more than one %s.' % self.model.__name__)
+        return result[0]
+
+    # in_bulk，一条 in 查询取得多个主键对应的实例，返回 {pk: obj}
+    def in_bulk(self, pks):
+        primary_key = self.model.__primary_key__
+        if not primary_key:
+            raise TypeError('Primary key not defined in class: %s' % self.model.__name__)
+        pks = list(collections.OrderedDict.fromkeys(pks))
+        result = {}
+        scope = IdentityMap.current()
+        if scope is not None and self._is_unfiltered():
+            missing = []
+            for pk in pks:
+                inst = scope.get(self.model, pk)
+                if inst is None:
+                    missing.append(pk)
+                else:
+                    result[pk] = inst
+            pks = missing
+        if pks:
+            for inst in self.filter(pk__in=pks):
+                result[inst.pk] = inst
+        return result
+
+    def _is_unfiltered(self):
+        return not (self.query.filter_Q or self.query.exclude_Q or self.query.limit_dict)
+
+    # count，切片后的查询使用子查询计数
     def count(self):
         if self.select_result is not None:
             return len(self.select_result)
+        if self.query.limit_dict.get('limit') == 0:
+            return 0
 
-        # limit查询特殊处理
-        limit = self.query.limit_dict.get('limit', 0)
-        offset = self.query.limit_dict.get('offset', 0)
-        if limit or offset:
-            # 构建无limit_dict的query
-            count_query = self._clone()
-            count_query.query.limit_dict = {}
-            all_count = count_query.count()
-            # 根据实际数量及偏移量计算count
-            if offset > all_count:
-                select_count = 0
-            elif limit == 0 or offset + limit > all_count:
-                select_count = all_count - offset
-            else:
-                select_count = limit
-        else:
-            # 无数量限制，使用count查询
-            sql, params = self.query.sql_expr(method='count')
-            (select_count,) = Database.execute(self.model.__db_label__, sql, params).fetchone()
-        return select_count
+        targets = self._targets(self.query)
+        if len(targets) == 1:
+            (select_count,) = self._read_target(targets[0], fetch_one, 'count')
+            return select_count
+
+        # 跨分片或 in 分块：各部分未切片的数量求和后按切片截取
+        self._check_scatter()
+        query = self.query.clone()
+        query.limit_dict = {}
+        select_count = sum(count for (count,) in self._scatter(self._targets(query), fetch_one, 'count'))
+        select_count = max(select_count - self.query.limit_dict.get('offset', 0), 0)
+        limit = self.query.limit_dict.get('limit')
+        return select_count if limit is None else min(select_count, limit)
 
     # update
     def update(self, **kwargs):
         if kwargs:
             _, kwargs = self.pk_replace(**kwargs)
-            sql, params = self.query.sql_expr(method='update', update_dict=kwargs)
-            Database.execute(self.model.__db_label__, sql, params)
+            self._write(self.query, 'update', kwargs)
+            scope = IdentityMap.current()
+            if scope is not None:
+                scope.discard_model(self.model)
+
+    # 在每个 db_label 上执行写操作并使结果缓存失效，同一 db_label 上的多条语句（in 分块）在一个事务中执行
+    def _write(self, query, method, update_dict=None):
+        def write(db_label, target_query):
+            sql, params = target_query.sql_expr(method=method, update_dict=update_dict)
+            Database.execute(db_label, sql, params, queryset=self)
+            invalidate_cache(db_label, self.model.__db_table__)
+
+        def write_label(db_label, targets):
+            if len(targets) == 1:
+                return self._in_target(targets[0], write)
+            with Database.atomic(db_label):
+                for target in targets:
+                    self._in_target(target, write)
+
+        groups = collections.OrderedDict()
+        for target in self._targets(query, write=True, update_dict=update_dict):
+            groups.setdefault(target[0], []).append(target)
+        Database.run_concurrently([functools.partial(write_label, db_label, targets)
+                                   for db_label, targets in groups.items()])
+
+    # using，指定执行查询的 db_label（分片），返回一个新的QuerySet对象
+    def using(self, db_label):
+        obj = self._clone()
+        obj.db_label = db_label
+        return obj
+
+    # 查询涉及的 db_label：分片模型 filter 中有分片键的等值或 in 条件时只查对应分片，否则为全部分片
+    def _db_labels(self, query=None):
+        if self.db_label is not None:
+            return [self.db_label]
+        shard_key = self.model.__shard_key__
+        if not shard_key:
+            return [self.model.__db_label__]
+        sharding = self.model.__sharding__
+        filter_Q = (query or self.query).filter_Q
+        if filter_Q.connector == 'AND' and not filter_Q.negated:
+            for child in filter_Q.children:
+                if isinstance(child, Q):
+                    continue
+                key, value = child
+                if key == shard_key:
+                    return [sharding.get_db_label(value)]
+                if key == shard_key + '__in' and isinstance(value, (list, tuple, set, frozenset)):
+                    return list(collections.OrderedDict.fromkeys(sharding.get_db_label(val) for val in value))
+        return sharding.db_labels
+
+    # 按实例所在分片分组，返回 [(db_label, items)]
+    def _shard_groups(self, items, get_obj=None):
+        if self.db_label is not None or not self.model.__shard_key__:
+            return [(self._db_labels()[0], items)]
+        groups = collections.OrderedDict()
+        for item in items:
+            obj = item if get_obj is None else get_obj(item)
+            groups.setdefault(obj._db_label(), []).append(item)
+        return groups.items()
+
+    # 执行查询的 [(db_label, Query, 临时表)]，没有大 in 条件时为每个分片一项
+    # 超过 in_chunk_size 个值的 in 条件：filter 顶层 and 中只有一个时按 in_chunk_size 及 max_allowed_packet 分块，
+    # 每块一条语句，结果与跨分片查询一样合并；去重后超过 in_temp_table_threshold 个值，
+    # 或无法合并（多个、嵌套、exclude 中、分组或 distinct 聚合、切片后写入、更新 Case、有排序的流式读取）时写入临时表
+    def _targets(self, query, write=False, stream=False, update_dict=None):
+        db_labels = self._db_labels(query)
+        db_config = Database.db_config.get(db_labels[0], {})
+        chunk_size = db_config.get('in_chunk_size', DEFAULT_IN_CHUNK_SIZE)
+        large = query.filter_Q.large_in(chunk_size) + query.exclude_Q.large_in(chunk_size)
+        if not large:
+            return [(db_label, query, None) for db_label in db_labels]
+
+        filter_Q = query.filter_Q
+        chunk_index = None
+        if len(large) == 1 and filter_Q.connector == 'AND' and not filter_Q.negated and \
+                self._can_chunk(query, write, stream, update_dict):
+            for index, child in enumerate(filter_Q.children):
+                if child is large[0]:
+                    chunk_index = index
+        if chunk_index is not None:
+            query_str, values = large[0]
+            values = unique_values(values)
+            if len(values) <= db_config.get('in_temp_table_threshold', DEFAULT_IN_TEMP_TABLE_THRESHOLD):
+                # 分片键的值先按分片分组，每块只查询一个分片
+                groups = [values]
+                shard_key = self.model.__shard_key__
+                if self.db_label is None and shard_key and query_str == shard_key + '__in':
+                    sharding = self.model.__sharding__
+                    shard_values = collections.OrderedDict()
+                    for value in values:
+                        shard_values.setdefault(sharding.get_db_label(value), []).append(value)
+                    groups = shard_values.values()
+                targets = []
+                for group in groups:
+                    for chunk in self._split_batches(db_labels[0], group, chunk_size, IN_CHUNK_RESERVED_BYTES,
+                                                     lambda value: estimate_literal_size(value) + 2):
+                        chunk_query = query.clone()
+                        chunk_query.filter_Q.children[chunk_index] = (query_str, tuple(chunk))
+                        targets.extend((db_label, chunk_query, None) for db_label in self._db_labels(chunk_query))
+                return targets
+
+        tables = []
+
+        def replace(field, values):
+            table = InTempTable('_in_values_%d' % len(tables), unique_values(values))
+            tables.append((field, table))
+            return table
+
+        temp_query = query.clone()
+        temp_query.filter_Q = query.filter_Q.replace_large_in(chunk_size, replace)
+        temp_query.exclude_Q = query.exclude_Q.replace_large_in(chunk_size, replace)
+        return [(db_label, temp_query, tables) for db_label in db_labels]
+
+    # 分块执行的结果能否合并为原查询的结果；更新的值中有 Case 时每块都要带上整个 Case，不分块
+    @staticmethod
+    def _can_chunk(query, write, stream, update_dict=None):
+        if write and query.limit_dict:
+            return False
+        if update_dict and any(isinstance(value, Case) for value in update_dict.values()):
+            return False
+        if stream and query.order_fields:
+            return False
+        if query.annotations:
+            if any(field not in query.annotations for field in query.select):
+                return False
+            if any(aggregate.distinct for aggregate in query.annotations.values()):
+                return False
+        return True
+
+    # 执行 func(db_label, query)，有临时表时在事务中建表及执行，使用同一连接，执行后删除临时表
+    def _in_target(self, target, func):
+        db_label, query, tables = target
+        if not tables:
+            return func(db_label, query)
+        with Database.atomic(db_label) as transaction:
+            try:
+                for field, table in tables:
+                    table.create(self, db_label, field)
+                return func(db_label, query)
+            finally:
+                if not transaction.broken:
+                    for _, table in tables:
+                        table.drop(self, db_label)
+
+    # 在一个 target 上执行只读查询
+    def _read_target(self, target, fetch, method='select'):
+        def read(db_label, query):
+            sql, params = query.sql_expr(method=method)
+            return self._read(db_label, sql, params, fetch)
+        return self._in_target(target, read)
+
+    # 流式读取一个 target，临时表只在建表的连接上可见，使用临时表时一次读取全部结果
+    def _stream_target(self, target, chunk_size):
+        db_label, query, tables = target
+        if tables:
+            return self._temp_table_rows(target)
+        sql, params = query.sql_expr()
+        return Database.stream(db_label, sql, params, chunk_size, self)
+
+    def _temp_table_rows(self, target):
+        for row in self._read_target(target, fetch_all):
+            yield row
+
+    # 在多个 target 上并发执行只读查询，返回各自的结果列表
+    def _scatter(self, targets, fetch, method='select'):
+        return Database.run_concurrently(
+            [functools.partial(self._read_target, target, fetch, method) for target in targets])
+
+    # 跨分片查询使用的 Query：各分片取前 offset + limit 行，排序字段不在 select 中时追加到末尾
+    # 返回 (query, 追加的字段数)
+    def _shard_query(self):
+        self._check_scatter()
+        query = self.query.clone()
+        limit = query.limit_dict.pop('limit', None)
+        offset = query.limit_dict.pop('offset', 0)
+        if limit is not None:
+            query.limit_dict['limit'] = offset + limit
+        extra = [field.lstrip('-') for field in query.order_fields if field.lstrip('-') not in query.select]
+        query.select = list(query.select) + extra
+        return query, len(extra)
+
+    # 客户端合并排序的 key，与 mysql 相同 null 排在最前
+    def _order_key(self, query):
+        columns = [(query.select.index(field.lstrip('-')), field[0] == '-') for field in query.order_fields]
+
+        def order_key(row):
+            key = []
+            for index, desc in columns:
+                value = (row[index] is not None, row[index])
+                key.append(DescendingKey(value) if desc else value)
+            return tuple(key)
+        return order_key
+
+    # 跨分片查询，合并排序后在客户端切片
+    def _scatter_select(self):
+        query, extra = self._shard_query()
+        rows = []
+        for shard_rows in self._scatter(self._targets(query), fetch_all):
+            rows.extend(shard_rows)
+        if query.order_fields:
+            rows.sort(key=self._order_key(query))
+        offset = self.query.limit_dict.get('offset', 0)
+        limit = self.query.limit_dict.get('limit')
+        rows = rows[offset:] if limit is None else rows[offset:offset + limit]
+        if extra:
+            rows = [row[:-extra] for row in rows]
+        return rows
+
+    # 跨分片流式读取，有排序时按 order_fields 归并各分片的结果
+    def _scatter_stream(self, chunk_size):
+        query, extra = self._shard_query()
+        streams = [self._stream_target(target, chunk_size) for target in self._targets(query, stream=True)]
+        if query.order_fields:
+            order_key = self._order_key(query)
+            decorated = [((order_key(row), index, row) for row in stream) for index, stream in enumerate(streams)]
+            rows = imap(operator.itemgetter(2), heapq.merge(*decorated))
+        else:
+            rows = itertools.chain(*streams)
+        offset = self.query.limit_dict.get('offset', 0)
+        limit = self.query.limit_dict.get('limit')
+        rows = itertools.islice(rows, offset, None if limit is None else offset + limit)
+        if extra:
+            rows = imap(operator.itemgetter(slice(0, -extra)), rows)
+        return rows
+
+    # aggregate，整个查询聚合为一行，返回 {别名: 值}：aggregate(total=Sum('b'), n=Count('*'))
+    # 未指定别名时为 字段_函数名，如 Sum('b') 为 b_sum，Count('*') 为 count
+    def aggregate(self, *args, **kwargs):
+        if self.query.limit_dict:
+            raise TypeError('Cannot aggregate a query once a slice has been taken.')
+        if self.query.annotations:
+            raise TypeError('Cannot aggregate an annotated query.')
+        query = self.query.clone()
+        query.annotations = self._resolve_annotations(args, kwargs)
+        query.select = list(query.annotations)
+        query.order_fields = []
+        targets = self._targets(query)
+        if len(targets) > 1:
+            return self._scatter_aggregate(query)
+        row = self._read_target(targets[0], fetch_one)
+        return dict(zip(query.select, row))
+
+    # 跨分片或 in 分块聚合：各部分分别聚合后合并，avg 拆为 sum 及 count
+    def _scatter_aggregate(self, query):
+        annotations = query.annotations
+        shard_annotations = collections.OrderedDict()
+        for alias, aggregate in annotations.items():
+            if aggregate.distinct:
+                raise TypeError('Cannot merge distinct aggregates across shards.')
+            if isinstance(aggregate, Avg):
+                shard_annotations[alias + '__sum'] = Sum(aggregate.field)
+                shard_annotations[alias + '__count'] = Count(aggregate.field)
+            else:
+                shard_annotations[alias] = aggregate
+        query.annotations = shard_annotations
+        query.select = list(shard_annotations)
+        rows = [dict(zip(query.select, row)) for row in self._scatter(self._targets(query), fetch_one)]
+
+        result = {}
+        for alias, aggregate in annotations.items():
+            if isinstance(aggregate, Avg):
+                total = sum(row[alias + '__sum'] for row in rows if row[alias + '__sum'] is not None)
+                count = sum(row[alias + '__count'] for row in rows)
+                if not count:
+                    result[alias] = None
+                elif isinstance(total, decimal.Decimal):
+                    result[alias] = total / count
+                else:
+                    result[alias] = float(total) / count
+            else:
+                values = [row[alias] for row in rows if row[alias] is not None]
+                result[alias] = aggregate.merge(values) if values else None
+        return result
+
+    # annotate，按 values()/values_list() 的字段分组并附加聚合值，之后 filter 聚合别名时使用 having
+    def annotate(self, *args, **kwargs):
+        if not isinstance(self, (ValuesQuerySet, ValuesListQuerySet)):
+            raise TypeError('annotate() must follow values() or values_list().')
+        if self.query.flat:
+            raise TypeError('flat is not valid with annotate().')
+        annotations = self._resolve_annotations(args, kwargs)
+        obj = self._clone()
+        query = obj.query
+        query.annotations = collections.OrderedDict(query.annotations)
+        if query.having_Q is None:
+            query.having_Q = Q()
+        for alias, aggregate in annotations.items():
+            if alias in query.annotations or alias in query.select:
+                raise TypeError('The annotation %s conflicts with an existing one.' % alias)
+            query.annotations[alias] = aggregate
+            query.select = list(query.select) + [alias]
+        return obj
+
+    def _resolve_annotations(self, args, kwargs):
+        annotations = collections.OrderedDict()
+        for aggregate in args:
+            if not isinstance(aggregate, Aggregate):
+                raise TypeError('%r is not an aggregate expression.' % (aggregate,))
+            annotations[aggregate.default_alias()] = aggregate
+        annotations.update(kwargs)
+        primary_key = self.model.__primary_key__
+        for alias, aggregate in annotations.items():
+            if not isinstance(aggregate, Aggregate):
+                raise TypeError('%r is not an aggregate expression.' % (aggregate,))
+            if alias in self.fields_list:
+                raise TypeError('The annotation %s conflicts with a field on the model.' % alias)
+            if '__' in alias:
+                raise TypeError("Annotation names cannot contain '__': %s" % alias)
+            if aggregate.field == 'pk' and primary_key:
+                aggregate = annotations[alias] = aggregate.__class__(primary_key, aggregate.distinct)
+            if aggregate.field == '*':
+                if not isinstance(aggregate, Count):
+                    raise TypeError("'*' is only valid in Count().")
+            elif aggregate.field not in self.fields_list:
+                raise TypeError('Cannot resolve keyword %s into field.' % aggregate.field)
+        return annotations
+
+    # 跨分片时不支持分组聚合，各分片的分组无法在客户端正确合并
+    def _check_scatter(self):
+        if self.query.annotations:
+            raise TypeError('annotate() across shards is not supported, filter on the shard key or use using().')
+
+    # 键集分页：按 order_by 的字段（末尾补充主键保证顺序唯一）取 last_key 之后的 size 行
+    # last_key 为上一页返回的 next_token 或排序字段的值，为 None 时取第一页；排序字段的值不能为 null
+    def paginate_after(self, last_key=None, size=20):
+        if size <= 0:
+            raise TypeError('size must be a positive integer.')
+        if self.query.limit_dict:
+            raise TypeError('Cannot paginate a query once a slice has been taken.')
+        order_fields = list(self.query.order_fields)
+        names = [field.lstrip('-') for field in order_fields]
+        primary_key = self.model.__primary_key__
+        if primary_key and primary_key not in names:
+            order_fields.append(primary_key)
+            names.append(primary_key)
+        if not order_fields:
+            raise TypeError('paginate_after() requires order_by() or a primary key.')
+
+        queryset = self.order_by(*order_fields)
+        if last_key is not None:
+            if isinstance(last_key, (list, tuple)):
+                values = list(last_key)
+                if len(values) != len(order_fields):
+                    raise TypeError('last_key must have one value for each of %s.' % order_fields)
+            else:
+                values = decode_page_token(last_key, order_fields)
+            queryset = queryset.filter(self._keyset_q(order_fields, values))
+
+        # 排序字段不在 select 中时追加查询，取得最后一行的排序值后去掉；多取一行判断是否有下一页，不使用 offset
+        queryset.query.limit_dict['limit'] = size + 1
+        select = list(queryset.query.select)
+        queryset.query.select = select + [name for name in names if name not in select]
+        queryset.select()
+        rows = list(queryset.select_result)
+        next_token = None
+        if len(rows) > size:
+            rows = rows[:size]
+            last_row = rows[-1]
+            next_token = encode_page_token(
+                order_fields, [last_row[queryset.query.select.index(name)] for name in names])
+        return Page(list(self._iterable([row[:len(select)] for row in rows])), next_token)
+
+    # 键集分页条件 (f1 > v1) or (f1 = v1 and f2 > v2) or ...，降序字段使用 <
+    @staticmethod
+    def _keyset_q(order_fields, values):
+        keyset_q = None
+        for index, field in enumerate(order_fields):
+            kwargs = dict((order_fields[i].lstrip('-'), values[i]) for i in range(index))
+            if field[0] == '-':
+                kwargs[field[1:] + '__lt'] = values[index]
+            else:
+                kwargs[field + '__gt'] = values[index]
+            q_object = Q(**kwargs)
+            keyset_q = q_object if keyset_q is None else keyset_q | q_object
+        return keyset_q
 
     # order_by函数，返回一个新的QuerySet对象
     def order_by(self, *args):
@@ -321,14 +1477,146 @@ class QuerySet(object):
         obj.save()
         return obj
 
-    # exists
+    # bulk_create，按 batch_size 及 max_allowed_packet 分批执行多行 insert
+    def bulk_create(self, objs, batch_size=None, ignore=False):
+        objs = list(objs)
+        if not objs:
+            return objs
+        if batch_size is not None and batch_size <= 0:
+            raise TypeError('batch_size must be a positive integer.')
+
+        model = self.model
+        rows = [(obj, obj._field_dict()) for obj in objs]
+        fields = [field for field in model.field_list if any(field in field_dict for _, field_dict in rows)]
+        if not fields:
+            raise TypeError('Cannot bulk create %s objects without any field set.' % model.__name__)
+        base_size = len(model.__db_table__) + sum(len(field) + 2 for field in fields) + 32
+
+        def row_size(row):
+            field_dict = row[1]
+            return sum(estimate_literal_size(field_dict.get(field)) + 2 for field in fields) + 4
+
+        for db_label, shard_rows in self._shard_groups(rows, operator.itemgetter(0)):
+            for batch in self._split_batches(db_label, shard_rows, batch_size, base_size, row_size):
+                self._bulk_insert(db_label, fields, batch, ignore)
+        return objs
+
+    # 按 batch_size 及 max_allowed_packet 将对象分批
+    def _split_batches(self, db_label, objs, batch_size, base_size, row_size):
+        db_config = Database.db_config.get(db_label, {})
+        max_packet = db_config.get('max_allowed_packet', DEFAULT_MAX_ALLOWED_PACKET)
+        batch = []
+        batch_bytes = base_size
+        for obj in objs:
+            row_bytes = row_size(obj)
+            if batch and (len(batch) == batch_size or batch_bytes + row_bytes > max_packet):
+                yield batch
+                batch = []
+                batch_bytes = base_size
+            batch.append(obj)
+            batch_bytes += row_bytes
+        if batch:
+            yield batch
+
+    # rows 为 (obj, 已赋值字段) 列表
+    def _bulk_insert(self, db_label, fields, rows, ignore):
+        model = self.model
+        primary_key = model.__primary_key__
+        objs = [obj for obj, _ in rows]
+        values_list = []
+        params = []
+        auto_pk = bool(primary_key) and not ignore
+        for obj, field_dict in rows:
+            placeholders = []
+            for field in fields:
+                value = field_dict.get(field)
+                # 未赋值的字段（及为空的主键）使用数据库默认值
+                if field not in field_dict or (field == primary_key and value is None):
+                    placeholders.append('default')
+                else:
+                    placeholders.append('%s')
+                    params.append(value)
+                    if field == primary_key:
+                        auto_pk = False
+            values_list.append('(' + ', '.join(placeholders) + ')')
+        sql = 'insert %sinto %s(%s) values %s;' % (
+            'ignore ' if ignore else '', model.__db_table__, ', '.join(fields), ', '.join(values_list))
+        cursor = Database.execute(db_label, sql, params, queryset=self)
+        invalidate_cache(db_label, model.__db_table__)
+        # 整批均由自增生成主键时，lastrowid 为第一行的主键，后续按步长连续分配
+        if auto_pk and cursor.lastrowid:
+            step = Database.db_config.get(db_label, {}).get('auto_increment_increment', 1)
+            for index, obj in enumerate(objs):
+                obj._set_pk_val(cursor.lastrowid + index * step)
+        for obj in objs:
+            obj._mark_saved()
+
+    # bulk_update，每批编译为一条 update ... set col = case pk when ... end where pk in (...)
+    def bulk_update(self, objs, fields, batch_size=None):
+        if not fields:
+            raise TypeError('Field names must be given to bulk_update().')
+        if batch_size is not None and batch_size <= 0:
+            raise TypeError('batch_size must be a positive integer.')
+        primary_key = self.model.__primary_key__
+        if not primary_key:
+            raise TypeError('Primary key not defined in class: %s' % self.model.__name__)
+        fields = list(self.field_check(tuple(fields)))
+        if primary_key in fields:
+            raise TypeError('bulk_update() cannot be used with primary key fields.')
+
+        # 相同主键以最后一个对象为准
+        objs_dict = collections.OrderedDict()
+        for obj in objs:
+            if obj.pk is None:
+                raise TypeError('All bulk_update() objects must have a primary key set.')
+            objs_dict[obj.pk] = obj
+        if not objs_dict:
+            return
+
+        base_size = len(self.model.__db_table__) + sum(len(field) * 2 + len(primary_key) + 32 for field in fields)
+
+        def row_size(obj):
+            pk_size = estimate_literal_size(obj.pk) + 2
+            return pk_size + sum(pk_size + estimate_literal_size(getattr(obj, field)) + 12 for field in fields)
+
+        for db_label, shard_objs in self._shard_groups(list(objs_dict.values())):
+            # 每批不超过 in_chunk_size，主键的 in 条件不会再被分块
+            in_chunk_size = Database.db_config.get(db_label, {}).get('in_chunk_size', DEFAULT_IN_CHUNK_SIZE)
+            shard_batch_size = min(batch_size or in_chunk_size, in_chunk_size)
+            for batch in self._split_batches(db_label, shard_objs, shard_batch_size, base_size, row_size):
+                update_dict = {}
+                for field in fields:
+                    whens = [(obj.pk, getattr(obj, field)) for obj in batch]
+                    update_dict[field] = Case(primary_key, whens, default=field)
+                queryset = self.using(db_label).filter(pk__in=[obj.pk for obj in batch])
+                queryset._write(queryset.query, 'update', update_dict)
+                for obj in batch:
+                    obj._mark_saved(fields)
+
+    # exists，select 1 ... limit 1
     def exists(self):
-        return bool(self.count())
+        if self.select_result is not None:
+            return bool(self.select_result)
+        if self.query.limit_dict.get('limit') == 0:
+            return False
+
+        targets = self._targets(self.query)
+        if len(targets) == 1:
+            return self._read_target(targets[0], fetch_exists, 'exists')
+        self._check_scatter()
+        if self.query.limit_dict:
+            return self.count() > 0
+        return any(self._scatter(targets, fetch_exists, 'exists'))
 
     # delete
     def delete(self):
-        sql, params = self.query.sql_expr(method='delete')
-        Database.execute(self.model.__db_label__, sql, params)
+        db_labels = self._db_labels()
+        if len(db_labels) > 1 and self.query.limit_dict:
+            raise TypeError('Cannot delete a sliced query across shards.')
+        self._write(self.query, 'delete')
+        scope = IdentityMap.current()
+        if scope is not None:
+            scope.discard_model(self.model)
 
     # values
     def values(self, *args):
@@ -382,8 +1670,24 @@ class QuerySet(object):
     # sql查询基础函数
     def select(self):
         if self.select_result is None:
-            sql, params = self.query.sql_expr()
-            self.select_result = Database.execute(self.model.__db_label__, sql, params).fetchall()
+            targets = self._targets(self.query)
+            if len(targets) == 1:
+                self.select_result = self._read_target(targets[0], fetch_all)
+            else:
+                self.select_result = self._scatter_select()
+
+    # 与其他 QuerySet 并发执行查询，见 Database.gather
+    def prefetch_concurrently(self, *querysets):
+        Database.gather(self, *querysets)
+        return self
+
+    # 执行只读查询，模型设置了 __cache__ 时使用结果缓存
+    def _read(self, db_label, sql, params, fetch):
+        result_cache = self.model._result_caches.get(db_label)
+        # 事务中可能读到未提交的数据，不使用缓存
+        if result_cache is None or Database.in_transaction(db_label):
+            return fetch(Database.execute(db_label, sql, params, readonly=True, queryset=self))
+        return result_cache.fetch(sql, params, fetch, self)
 
     def base_index(self, index):
         if self.select_result is None:
@@ -397,7 +1701,7 @@ class QuerySet(object):
     # 索引值查询
     def get_index(self, index):
         index_value = self.base_index(index)
-        return self.model(**dict(zip(self.fields_list, index_value)))
+        return self._row_factory([index_value])(tuple(index_value))
 
     def _clone(self, klass=None, select=None, flat=False):
         if klass is None:
@@ -408,18 +1712,32 @@ class QuerySet(object):
         if flat:
             query.flat = flat
         obj = klass(model=self.model, query=query)
+        obj.db_label = self.db_label
         return obj
 
     # 根据传入的筛选条件，返回新的QuerySet对象
     def _filter_or_exclude(self, negate, *args, **kwargs):
         clone = self._clone()
         new_q = self._add_q(Q(*args, **kwargs))
-        if negate:
+        if self.query.annotations and self._refers_to(new_q, self.query.annotations):
+            # 聚合别名的条件放在 having 中
+            clone.query.having_Q.add(~new_q if negate else new_q, 'AND')
+        elif negate:
             clone.query.exclude_Q.add(new_q, 'AND')
         else:
             clone.query.filter_Q.add(new_q, 'AND')
         return clone
 
+    # Q 对象中是否有 names 中字段的条件
+    def _refers_to(self, q_object, names):
+        for child in q_object.children:
+            if isinstance(child, Q):
+                if self._refers_to(child, names):
+                    return True
+            elif child[0].split('__')[0] in names:
+                return True
+        return False
+
     def _add_q(self, q_object):
         connector = q_object.connector
         new_q = Q()
@@ -462,7 +1780,7 @@ class QuerySet(object):
                     limit = self_offset + self_limit - offset
 
             obj.query.limit_dict['offset'] = offset
-            if limit:
+            if limit is not None:
                 obj.query.limit_dict['limit'] = limit
             # 返回新的QuerySet对象
             return obj
@@ -474,30 +1792,286 @@ class QuerySet(object):
         else:
             return None
 
+    # 流式迭代，使用服务端游标按 chunk_size 分批读取，不缓存到 select_result
+    def iterator(self, chunk_size=2000):
+        return self._iterable(self._stream_rows(chunk_size))
+
+    # 流式读取的原始结果行，已有缓存时直接使用缓存
+    def _stream_rows(self, chunk_size):
+        if self.select_result is not None:
+            return self.select_result
+        targets = self._targets(self.query, stream=True)
+        if len(targets) > 1:
+            return self._scatter_stream(chunk_size)
+        return self._stream_target(targets[0], chunk_size)
+
+    # 按主键范围分块遍历，每块为 pk__range=(a, b) 的 QuerySet，保留原有筛选条件
+    # 每块包含 chunk_size 个符合条件的行；after 为上次处理到的主键，从其后继续
+    def iter_pk_chunks(self, chunk_size=1000, after=None):
+        for low, high in self._pk_ranges(chunk_size, after):
+            yield self.filter(pk__range=(low, high))
+
+    # 主键范围 (a, b)，下一块的起点在返回当前块之前取得，处理当前块时修改数据不影响分块
+    def _pk_ranges(self, chunk_size, after=None):
+        primary_key = self.model.__primary_key__
+        if not primary_key:
+            raise TypeError('Primary key not defined in class: %s' % self.model.__name__)
+        if chunk_size <= 0:
+            raise TypeError('chunk_size must be a positive integer.')
+        if self.query.limit_dict:
+            raise TypeError('Cannot chunk a query once a slice has been taken.')
+        pks = self.order_by(primary_key).values_list(primary_key, flat=True)
+        if after is not None:
+            pks = pks.filter(pk__gt=after)
+        low = pks.first()
+        while low is not None:
+            bounds = list(pks.filter(pk__gte=low)[chunk_size - 1:chunk_size + 1])
+            if bounds:
+                high = bounds[0]
+                next_low = bounds[1] if len(bounds) > 1 else None
+            else:
+                high = pks.filter(pk__gte=low).order_by('-' + primary_key).first()
+                next_low = None
+            yield low, high
+            low = next_low
+
+    # 按主键范围分块后在线程池或进程池中执行 fn(每块的 QuerySet)，返回按块顺序的结果列表
+    # executor 为 'process' 时 fn 需可 pickle，子进程重新建立连接池；每个 worker 同时只使用一个连接
+    # progress(已完成块数, watermark) 在每块按顺序完成后调用，watermark 为已全部处理的最大主键，中断后以 after=watermark 继续
+    def parallel_map(self, fn, workers=4, chunk_size=1000, executor='thread', progress=None, after=None):
+        if executor == 'thread':
+            from concurrent.futures import ThreadPoolExecutor
+            pool = ThreadPoolExecutor(max_workers=workers)
+        elif executor == 'process':
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=Database.reset_pools,
+                                       initargs=(Database.db_config,))
+        else:
+            raise TypeError("executor must be 'thread' or 'process'.")
+
+        queryset = self._clone()
+        results = []
+        pending = collections.deque()
+
+        def collect():
+            high, future = pending.popleft()
+            results.append(future.result())
+            if progress is not None:
+                progress(len(results), high)
+
+        try:
+            for low, high in queryset._pk_ranges(chunk_size, after):
+                pending.append((high, pool.submit(run_pk_chunk, fn, queryset, low, high)))
+                # 限制提交的块数，分块边界随处理进度读取
+                if len(pending) >= workers * 2:
+                    collect()
+            while pending:
+                collect()
+        finally:
+            for _, future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+        return results
+
+    # only，只查询指定字段及主键，其余字段为延迟字段
+    def only(self, *fields):
+        fields = set(self._deferrable_fields(fields))
+        primary_key = self.model.__primary_key__
+        return self._select_fields([field for field in self.fields_list if field in fields or field == primary_key])
+
+    # defer，不查询指定字段，可多次调用累加
+    def defer(self, *fields):
+        fields = set(self._deferrable_fields(fields))
+        if self.model.__primary_key__ in fields:
+            raise TypeError('The primary key cannot be deferred.')
+        return self._select_fields([field for field in self.query.select if field not in fields])
+
+    def _deferrable_fields(self, fields):
+        if not self.model.__primary_key__:
+            raise TypeError('Primary key not defined in class: %s' % self.model.__name__)
+        if not fields:
+            raise TypeError('Field names must be given.')
+        return self.field_check(fields)
+
+    def _select_fields(self, select):
+        if isinstance(self, (ValuesQuerySet, ValuesListQuerySet)):
+            raise TypeError('only() and defer() cannot be used after values() or values_list().')
+        obj = self._clone()
+        obj.query.select = select
+        return obj
+
+    # 结果行构造函数，开启 IdentityMap 时相同主键返回同一实例
+    # only()/defer() 的查询由 DeferredLoader 记录 rows 的主键，首次访问延迟字段时一次加载
+    def _row_factory(self, rows=()):
+        select = self.query.select
+        factory = self.model.row_factory(select)
+        if len(select) != len(self.fields_list):
+            factory = DeferredLoader(self, select, rows).wrap(factory)
+        scope = IdentityMap.current()
+        if scope is not None:
+            factory = scope.wrap(self.model, select, factory)
+        return factory
+
+    # 将查询结果行转换为返回对象
+    def _iterable(self, rows):
+        if len(self.query.select) == len(self.fields_list) or isinstance(rows, (list, tuple)):
+            return imap(self._row_factory(rows), rows)
+        return self._deferred_chunks(rows)
+
+    # 流式读取 only()/defer() 的查询，每 DeferredLoader.batch_size 行使用一个 DeferredLoader
+    def _deferred_chunks(self, rows):
+        rows = iter(rows)
+        try:
+            while True:
+                chunk = list(itertools.islice(rows, DeferredLoader.batch_size))
+                if not chunk:
+                    break
+                for inst in imap(self._row_factory(chunk), chunk):
+                    yield inst
+        finally:
+            close = getattr(rows, 'close', None)
+            if close is not None:
+                close()
+
     # 返回自定义迭代器
     def __iter__(self):
         self.select()
-        for value in self.select_result:
-            inst = self.model(**dict(zip(self.fields_list, value)))
-            yield inst
+        return self._iterable(self.select_result)
 
     def __nonzero__(self):
-        return bool(self.count())
+        return self.exists()
 
     def __bool__(self):
-        return bool(self.count())
+        return self.exists()
+
+    # asyncio 接口，与同步方法执行相同的sql，await 返回结果
+    def acount(self):
+        return Database.run_async(self.count)
+
+    def aexists(self):
+        return Database.run_async(self.exists)
+
+    def afirst(self):
+        return Database.run_async(self.first)
+
+    def aget(self, *args, **kwargs):
+        return Database.run_async(self.get, *args, **kwargs)
+
+    def acreate(self, **kwargs):
+        return Database.run_async(self.create, **kwargs)
+
+    def aupdate(self, **kwargs):
+        return Database.run_async(self.update, **kwargs)
+
+    def adelete(self):
+        return Database.run_async(self.delete)
+
+    # async for，首次迭代时在线程池中执行查询
+    def __aiter__(self):
+        return AsyncQuerySetIterator(self)
 
     def __repr__(self):
         return '<QuerySet Obj>'
 
 
+# only()/defer() 一批结果行的主键及延迟字段，任一实例首次访问延迟字段时按主键分批查询全部行的延迟字段
+# 只保存主键及加载的值，不引用实例；实例取得自己的值后从 rows 中移除
+class DeferredLoader(object):
+    batch_size = 1000
+
+    def __init__(self, queryset, select, rows):
+        model = queryset.model
+        self.model = model
+        self.db_label = queryset.db_label
+        self.fields = [field for field in model.field_list if field not in select]
+        self.slots = dict(model.field_slots)
+        index = list(select).index(model.__primary_key__)
+        self.pks = [row[index] for row in rows]
+        self.rows = None
+
+    def wrap(self, factory):
+        def deferred_factory(row):
+            inst = factory(row)
+            inst._deferred = self
+            return inst
+        return deferred_factory
+
+    def load(self):
+        model = self.model
+        queryset = QuerySet(model)
+        queryset.db_label = self.db_label
+        pks = list(collections.OrderedDict.fromkeys(self.pks))
+        rows = {}
+        for start in range(0, len(pks), self.batch_size):
+            for row in queryset.filter(pk__in=pks[start:start + self.batch_size]).values_list(
+                    model.__primary_key__, *self.fields):
+                rows[row[0]] = row[1:]
+        self.rows = rows
+        self.pks = None
+
+    # 写入实例的延迟字段，已被赋值的字段不覆盖，加载的值加入实例的快照；查询出错时实例保留以便再次加载
+    def apply(self, inst):
+        if self.rows is None:
+            self.load()
+        row = self.rows.pop(inst.pk, None)
+        inst._deferred = None
+        if row is None:
+            return
+        slots = self.slots
+        loaded_fields = list(inst._loaded_fields)
+        loaded_row = list(inst._loaded_row)
+        for field, value in zip(self.fields, row):
+            try:
+                slots[field].__get__(inst, None)
+            except AttributeError:
+                setattr(inst, field, value)
+                loaded_fields.append(field)
+                loaded_row.append(value)
+        inst._loaded_fields = tuple(loaded_fields)
+        inst._loaded_row = tuple(loaded_row)
+
+
+# parallel_map 的任务函数，进程池中按引用 pickle
+def run_pk_chunk(fn, queryset, low, high):
+    return fn(queryset.filter(pk__range=(low, high)))
+
+
+class AsyncQuerySetIterator(object):
+    def __init__(self, queryset):
+        self.queryset = queryset
+        self.iterator = None
+
+    def _first(self):
+        self.iterator = iter(self.queryset)
+        return self._next()
+
+    def _next(self):
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        if self.iterator is None:
+            return Database.run_async(self._first)
+        import asyncio
+        future = asyncio.get_event_loop().create_future()
+        try:
+            future.set_result(self._next())
+        except StopAsyncIteration as e:
+            future.set_exception(e)
+        return future
+
+
 class ValuesQuerySet(QuerySet):
 
-    def __iter__(self):
-        self.select()
-        for value in self.select_result:
-            inst = {field: value[index] for index, field in enumerate(self.query.select)}
-            yield inst
+    def _iterable(self, rows):
+        select = self.query.select
+        for value in rows:
+            yield dict(zip(select, value))
 
     def get_index(self, index):
         index_value = self.base_index(index)
@@ -511,17 +2085,18 @@ class ValuesListQuerySet(QuerySet):
     def __init__(self, *args, **kwargs):
         super(ValuesListQuerySet, self).__init__(*args, **kwargs)
         self.flat = self.query.flat
-        self.select_field = self.query.select
         if self.flat and len(self.select_field) != 1:
             raise TypeError('flat is not valid when values_list is called with more than one field.')
 
-    def __iter__(self):
-        self.select()
-        for value in self.select_result:
-            if self.flat:
-                yield value[0]
-            else:
-                yield value
+    # 查询的列，annotate() 会在克隆后追加聚合别名
+    @property
+    def select_field(self):
+        return self.query.select
+
+    def _iterable(self, rows):
+        if self.flat:
+            return imap(operator.itemgetter(0), rows)
+        return iter(rows)
 
     def get_index(self, index):
         index_value = self.base_index(index)
@@ -530,6 +2105,101 @@ class ValuesListQuerySet(QuerySet):
         else:
             return index_value
 
+    # 按列返回结果 {字段: 列}，flat 时直接返回该列；按 chunk_size 流式读取，每批转置后追加到各列，不保留行元组
+    # 整数列为 array('q')，浮点列为 array('d')，其余（含 None、Decimal、字符串）为 list
+    # typecodes 为单个 typecode 或 {字段: typecode}，指定的列转换失败时抛出异常
+    def to_columns(self, typecodes=None, chunk_size=2000):
+        typecodes = self._column_types(typecodes, 'typecodes')
+        columns = [array.array(typecode) if typecode else [] for typecode in typecodes]
+        inferred = [typecode is None for typecode in typecodes]
+        for chunk in self._row_chunks(chunk_size):
+            for i, values in enumerate(zip(*chunk)):
+                column = columns[i]
+                if inferred[i]:
+                    inferred[i] = False
+                    typecode = self._infer_typecode(values)
+                    if typecode and not column:
+                        column = columns[i] = array.array(typecode)
+                if isinstance(column, list):
+                    column.extend(values)
+                    continue
+                try:
+                    column.extend(array.array(column.typecode, values))
+                except (TypeError, OverflowError):
+                    if typecodes[i]:
+                        raise
+                    column = columns[i] = column.tolist()
+                    column.extend(values)
+        return self._named_columns(columns)
+
+    # 按列返回 numpy 数组，flat 时直接返回该数组；各列按批写入预分配的数组，容量不足时原地扩容一倍
+    # dtypes 为单个 dtype 或 {字段: dtype}；未指定的列由数据推断，遇到不兼容的值时提升类型，字符串等为 object
+    def to_numpy(self, dtypes=None, chunk_size=2000):
+        if numpy is None:
+            raise ImportError('to_numpy() requires numpy.')
+        dtypes = self._column_types(dtypes, 'dtypes')
+        columns = [numpy.empty(0, dtype=dtype or object) for dtype in dtypes]
+        inferred = [dtype is None for dtype in dtypes]
+        size = 0
+        for chunk in self._row_chunks(chunk_size):
+            end = size + len(chunk)
+            for i, values in enumerate(zip(*chunk)):
+                column = columns[i]
+                if inferred[i]:
+                    values = numpy.asarray(values)
+                    if values.dtype.kind not in 'biuf':
+                        values = numpy.array(values.tolist(), dtype=object)
+                    if not size:
+                        column = column.astype(values.dtype)
+                    elif not numpy.can_cast(values.dtype, column.dtype):
+                        column = column.astype(numpy.result_type(column.dtype, values.dtype))
+                if end > len(column):
+                    column.resize(max(end, len(column) * 2, chunk_size), refcheck=False)
+                column[size:end] = values
+                columns[i] = column
+            size = end
+        for column in columns:
+            column.resize(size, refcheck=False)
+        return self._named_columns(columns)
+
+    # 每次读取 chunk_size 行，中途停止时关闭流式读取
+    def _row_chunks(self, chunk_size):
+        rows = iter(self._stream_rows(chunk_size))
+        try:
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            close = getattr(rows, 'close', None)
+            if close is not None:
+                close()
+
+    # 各列的类型，types 为 None、单个类型或 {字段: 类型}
+    def _column_types(self, types, name):
+        if not isinstance(types, dict):
+            return [types] * len(self.select_field)
+        unknown = set(types) - set(self.select_field)
+        if unknown:
+            raise TypeError('%s given for fields not in values_list(): %s' % (name, ', '.join(sorted(unknown))))
+        return [types.get(field) for field in self.select_field]
+
+    # 由第一批数据推断 array 的 typecode，不适用时为 None（使用 list）
+    @staticmethod
+    def _infer_typecode(values):
+        value_types = set(map(type, values))
+        if value_types <= INT_TYPES:
+            return INT_TYPECODE
+        if value_types == {float}:
+            return 'd'
+        return None
+
+    def _named_columns(self, columns):
+        if self.flat:
+            return columns[0]
+        return collections.OrderedDict(zip(self.select_field, columns))
+
     def __repr__(self):
         return '<ValuesListQuerySet Obj>'
 
@@ -556,15 +2226,63 @@ class Manager():
     def first(self):
         return self.get_queryset().first()
 
+    def get(self, *args, **kwargs):
+        return self.get_queryset().get(*args, **kwargs)
+
+    def acount(self):
+        return self.get_queryset().acount()
+
+    def aexists(self):
+        return self.get_queryset().aexists()
+
+    def afirst(self):
+        return self.get_queryset().afirst()
+
+    def aget(self, *args, **kwargs):
+        return self.get_queryset().aget(*args, **kwargs)
+
+    def acreate(self, **kwargs):
+        return self.get_queryset().acreate(**kwargs)
+
+    def in_bulk(self, pks):
+        return self.get_queryset().in_bulk(pks)
+
     def exists(self):
         return self.get_queryset().exists()
 
     def create(self, **kwargs):
         return self.get_queryset().create(**kwargs)
 
+    def bulk_create(self, objs, batch_size=None, ignore=False):
+        return self.get_queryset().bulk_create(objs, batch_size, ignore)
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        return self.get_queryset().bulk_update(objs, fields, batch_size)
+
     def order_by(self, *args):
         return self.get_queryset().order_by(*args)
 
+    def using(self, db_label):
+        return self.get_queryset().using(db_label)
+
+    def paginate_after(self, last_key=None, size=20):
+        return self.get_queryset().paginate_after(last_key, size)
+
+    def aggregate(self, *args, **kwargs):
+        return self.get_queryset().aggregate(*args, **kwargs)
+
+    def only(self, *fields):
+        return self.get_queryset().only(*fields)
+
+    def defer(self, *fields):
+        return self.get_queryset().defer(*fields)
+
+    def iter_pk_chunks(self, chunk_size=1000, after=None):
+        return self.get_queryset().iter_pk_chunks(chunk_size, after)
+
+    def parallel_map(self, fn, workers=4, chunk_size=1000, executor='thread', progress=None, after=None):
+        return self.get_queryset().parallel_map(fn, workers, chunk_size, executor, progress, after)
+
     def values(self, *args):
         return self.get_queryset().values(*args)
 
@@ -572,11 +2290,68 @@ class Manager():
         return self.get_queryset().values_list(*args)
 
 
+# 降序字段的排序 key
+class DescendingKey(object):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+# 分片规则：分片键按整数取模，mysql 中比较相等的值落在同一分片
+# 整数、整数值的浮点数及 Decimal、表示整数的字符串（'5'、'5.0'）转换为 int 后取模，其他值按 str 的 crc32 取模
+class HashSharding(object):
+    def __init__(self, db_labels):
+        if not db_labels:
+            raise TypeError('HashSharding requires at least one db label.')
+        self.db_labels = list(db_labels)
+
+    def get_db_label(self, value):
+        return self.db_labels[self.hash_value(value) % len(self.db_labels)]
+
+    @staticmethod
+    def hash_value(value):
+        if type(value) in INT_TYPES:
+            return int(value)
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        if isinstance(value, (int, float, decimal.Decimal, str, type(u''))):
+            try:
+                number = decimal.Decimal(value.strip() if isinstance(value, (str, type(u''))) else value)
+            except (decimal.InvalidOperation, ValueError):
+                number = None
+            if number is not None and number.is_finite() and number == number.to_integral_value():
+                return int(number)
+        return zlib.crc32((u'%s' % value).encode('utf-8')) & 0xffffffff
+
+
+# 分片规则：ranges 为按上界升序的 [(上界(不含), db_label), ...]，最后一个上界为 None 表示不设上界
+class RangeSharding(object):
+    def __init__(self, ranges):
+        if not ranges:
+            raise TypeError('RangeSharding requires at least one range.')
+        self.bounds = [bound for bound, _ in ranges if bound is not None]
+        self.range_labels = [db_label for _, db_label in ranges]
+        self.db_labels = list(collections.OrderedDict.fromkeys(self.range_labels))
+
+    def get_db_label(self, value):
+        index = bisect.bisect_right(self.bounds, value)
+        if index >= len(self.range_labels):
+            raise TypeError('No shard defined for shard key value %r.' % (value,))
+        return self.range_labels[index]
+
+
 class MetaModel(type):
-    def __init__(cls, name, bases, attrs):
-        super(MetaModel, cls).__init__(name, bases, attrs)
+    # 字段保存在 __slots__ 中，实例不再创建 __dict__
+    def __new__(mcs, name, bases, attrs):
         if name == 'Model':
-            return
+            return super(MetaModel, mcs).__new__(mcs, name, bases, attrs)
 
         __db_table__ = attrs.get('__db_table__')
         if not __db_table__:
@@ -584,18 +2359,46 @@ class MetaModel(type):
 
         field_list = []
         primary_key = None
-        for key, val in cls.__dict__.items():
+        slot_attrs = dict(attrs)
+        for key, val in attrs.items():
             if isinstance(val, Field):
                 if val.primary_key:
                     if primary_key:
                         raise TypeError('Cannot define more than 1 primary key in class: %s' % name)
                     primary_key = key
                 field_list.append(key)
-                setattr(cls, key, None)
+                del slot_attrs[key]
+        extra_slots = slot_attrs.get('__slots__', ())
+        if isinstance(extra_slots, str):
+            extra_slots = (extra_slots,)
+        slot_attrs['__slots__'] = tuple(field_list) + tuple(extra_slots)
+
+        cls = super(MetaModel, mcs).__new__(mcs, name, bases, slot_attrs)
         cls.field_list = field_list
+        cls.field_set = frozenset(field_list)
+        cls.field_slots = [(field, cls.__dict__[field]) for field in field_list]
         cls.attrs = attrs
         cls.objects = Manager(cls)
         cls.__primary_key__ = primary_key
+        cls._row_factories = {}
+        cls.DoesNotExist = type('DoesNotExist', (ObjectDoesNotExist,), {'__module__': cls.__module__})
+        cls.MultipleObjectsReturned = type('MultipleObjectsReturned', (MultipleObjectsReturned,),
+                                           {'__module__': cls.__module__})
+        shard_key = attrs.get('__shard_key__')
+        if shard_key:
+            if shard_key not in field_list:
+                raise TypeError('__shard_key__ %s is not a field of %s' % (shard_key, name))
+            if attrs.get('__sharding__') is None:
+                raise TypeError('__sharding__ is not defined in %s ' % name)
+            db_labels = cls.__sharding__.db_labels
+        else:
+            db_labels = [attrs.get('__db_label__')]
+        cache_config = attrs.get('__cache__')
+        cls._result_caches = {}
+        if cache_config:
+            for db_label in db_labels:
+                cls._result_caches[db_label] = ResultCache(db_label, __db_table__, cache_config)
+        return cls
 
 
 def with_metaclass(meta, *bases):
@@ -612,9 +2415,37 @@ def with_metaclass(meta, *bases):
     return metaclass('temporary_class', None, {})
 
 
-class Model(with_metaclass(MetaModel, dict)):
+# 生成按字段顺序将结果行赋值到实例的构造函数
+def make_row_factory(model, fields):
+    fields = tuple(fields)
+    if not fields:
+        raise TypeError('Cannot build %s objects without any field.' % model.__name__)
+    source = ('def row_factory(row):\n'
+              '    inst = new(model)\n'
+              '    %s, = row\n'
+              '    inst._loaded_fields = fields\n'
+              '    inst._loaded_row = row\n'
+              '    return inst\n') % ', '.join(['inst.' + field for field in fields])
+    namespace = {'new': object.__new__, 'model': model, 'fields': fields}
+    exec(source, namespace)
+    return namespace['row_factory']
+
+
+class Model(with_metaclass(MetaModel, object)):
+    # _loaded_fields、_loaded_row 为从数据库加载或保存后的字段值快照，用于判断修改过的字段
+    # _deferred 为 only()/defer() 查询的 DeferredLoader
+    __slots__ = ('_loaded_fields', '_loaded_row', '_deferred')
+    field_list = []
+    field_set = frozenset()
+    _result_caches = {}
+    # 分片模型的分片键字段及分片规则（HashSharding、RangeSharding 或实现了 db_labels、get_db_label 的对象）
+    __shard_key__ = None
+    __sharding__ = None
 
     def __init__(self, **kw):
+        self._loaded_fields = ()
+        self._loaded_row = None
+        self._deferred = None
         for k, v in kw.items():
             if k in self.field_list:
                 setattr(self, k, v)
@@ -637,83 +2468,867 @@ class Model(with_metaclass(MetaModel, dict)):
 
     pk = property(_get_pk_val, _set_pk_val)
 
+    # 结果行构造函数，按 fields 缓存
+    @classmethod
+    def row_factory(cls, fields):
+        fields = tuple(fields)
+        factory = cls._row_factories.get(fields)
+        if factory is None:
+            factory = cls._row_factories[fields] = make_row_factory(cls, fields)
+        return factory
+
+    # 未赋值的字段返回 None，延迟字段在首次访问时加载
+    def __getattr__(self, name):
+        if name in self.field_set:
+            try:
+                loader = self._deferred
+            except AttributeError:
+                return None
+            if loader is not None and name in loader.fields:
+                loader.apply(self)
+                return getattr(self, name)
+            return None
+        raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+
+    # 已赋值的字段及其值
+    def _field_dict(self):
+        field_dict = collections.OrderedDict()
+        for field, slot in self.field_slots:
+            try:
+                field_dict[field] = slot.__get__(self, None)
+            except AttributeError:
+                pass
+        return field_dict
+
+    # 加载或上次保存时的字段值
+    def _loaded_dict(self):
+        if self._loaded_row is None:
+            return None
+        return dict(zip(self._loaded_fields, self._loaded_row))
+
+    # 加载或上次保存后修改过的字段
+    def _get_changed_fields(self):
+        loaded = self._loaded_dict() or {}
+        changed = []
+        for field, value in self._field_dict().items():
+            if field not in loaded or loaded[field] != value:
+                changed.append(field)
+        return changed
+
+    # 保存后更新快照，fields 为 None 时表示全部字段已写入，没有快照时只记录主键和写入的字段
+    def _mark_saved(self, fields=None):
+        field_dict = self._field_dict()
+        loaded = self._loaded_dict()
+        if fields is None:
+            loaded = field_dict
+        else:
+            if loaded is None:
+                primary_key = self.__class__.__primary_key__
+                loaded = dict([(primary_key, field_dict[primary_key])]) if primary_key in field_dict else {}
+            for field in fields:
+                if field in field_dict:
+                    loaded[field] = field_dict[field]
+        self._loaded_fields = tuple(loaded.keys())
+        self._loaded_row = tuple(loaded.values())
+
     def __repr__(self):
         return '<%s obj>' % self.__class__.__name__
 
     def __nonzero__(self):
-        return bool(self.__dict__)
+        return bool(self._field_dict())
 
     def __bool__(self):
-        return bool(self.__dict__)
+        return bool(self._field_dict())
 
     def __eq__(self, obj):
-        return self.__class__ == obj.__class__ and self.__dict__ == obj.__dict__
+        return self.__class__ == obj.__class__ and self._field_dict() == obj._field_dict()
 
     def __hash__(self):
-        kv_list = sorted(self.__dict__.items(), key=lambda x: x[0])
+        kv_list = sorted(self._field_dict().items(), key=lambda x: x[0])
         return hash(','.join(['"%s":"%s"' % x for x in kv_list]) + str(self.__class__))
 
-    def _insert(self):
-        insert = 'insert into %s(%s) values (%s);' % (
-            self.__db_table__, ', '.join(self.__dict__.keys()), ', '.join(['%s'] * len(self.__dict__)))
-        cursor = Database.execute(self.__db_label__, insert, self.__dict__.values())
-        if self.__primary_key__:
+    # upsert 为 True 时使用 insert ... on duplicate key update，主键已存在则更新其余字段
+    def _insert(self, upsert=False):
+        primary_key = self.__primary_key__
+        field_dict = self._field_dict()
+        fields = list(field_dict.keys())
+        insert = 'insert into %s(%s) values (%s)' % (
+            self.__db_table__, ', '.join(fields), ', '.join(['%s'] * len(fields)))
+        if upsert:
+            update_fields = [field for field in fields if field != primary_key] or [primary_key]
+            insert += ' on duplicate key update ' + ', '.join(
+                ['%s = values(%s)' % (field, field) for field in update_fields])
+        db_label = self._db_label()
+        cursor = Database.execute(db_label, insert + ';', [field_dict[field] for field in fields])
+        invalidate_cache(db_label, self.__db_table__)
+        if primary_key and not self.pk:
             last_rowid = cursor.lastrowid
             self._set_pk_val(last_rowid)
 
-    def save(self):
-        if not self.__primary_key__ or not self.pk:
+    # 按主键 update 指定字段
+    def _update(self, fields):
+        update_dict = dict([(field, getattr(self, field)) for field in fields])
+        self.__class__.objects.using(self._update_db_label()).filter(pk=self.pk).update(**update_dict)
+
+    # update 使用的 db_label，已加载的实例在快照中分片键的值所在的分片上更新；分片键改为其他分片的值时抛出异常
+    def _update_db_label(self):
+        db_label = self._db_label()
+        shard_key = self.__shard_key__
+        loaded = self._loaded_dict()
+        if shard_key and loaded is not None and loaded.get(shard_key) is not None:
+            loaded_label = self.__sharding__.get_db_label(loaded[shard_key])
+            if loaded_label != db_label:
+                raise TypeError('Cannot move %s to another shard by changing %s, delete it and create it again.'
+                                % (self.__class__.__name__, shard_key))
+        return db_label
+
+    # 实例所在的 db_label，分片模型由分片键的值决定
+    def _db_label(self):
+        shard_key = self.__shard_key__
+        if not shard_key:
+            return self.__db_label__
+        value = getattr(self, shard_key)
+        if value is None:
+            raise TypeError('Shard key %s of %s must be set before saving.' % (shard_key, self.__class__.__name__))
+        return self.__sharding__.get_db_label(value)
+
+    # 已设置主键时一条 upsert 完成保存；从数据库加载的实例只 update 修改过的字段，无修改则不执行
+    # force_insert 直接 insert，force_update 直接按主键 update，均不做存在性判断
+    # update_fields 只 update 指定字段
+    def save(self, force_insert=False, force_update=False, update_fields=None):
+        if force_insert and (force_update or update_fields is not None):
+            raise TypeError('Cannot force both insert and updating in model saving.')
+        primary_key = self.__primary_key__
+        loaded = self._loaded_dict()
+
+        if update_fields is not None:
+            update_fields = [primary_key if field == 'pk' else field for field in update_fields]
+            err_fields = set(update_fields) - set(self.field_list)
+            if err_fields:
+                raise TypeError('Cannot resolve keyword %s into field.' % list(err_fields)[0])
+            update_fields = [field for field in update_fields if field != primary_key]
+            if not update_fields:
+                return
+            if not primary_key or not self.pk:
+                raise TypeError('Cannot force an update in save() with no primary key.')
+            self._update(update_fields)
+            self._mark_saved(update_fields)
+            return
+
+        if force_update:
+            if not primary_key or not self.pk:
+                raise TypeError('Cannot force an update in save() with no primary key.')
+            self._update([field for field in self._field_dict() if field != primary_key])
+        elif force_insert or not primary_key or not self.pk:
             self._insert()
+        elif loaded is not None and loaded.get(primary_key) == self.pk:
+            changed = self._get_changed_fields()
+            if not changed:
+                return
+            self._update(changed)
         else:
-            cls = self.__class__
-            filtered = cls.objects.filter(pk=self.pk)
-            if filtered.exists():
-                temp_dict = dict({}, **self.__dict__)
-                del temp_dict[self.__primary_key__]
-                filtered.update(**temp_dict)
+            self._insert(upsert=True)
+        self._mark_saved()
+        scope = IdentityMap.current()
+        if scope is not None:
+            scope.add(self)
+
+
+# 连接池中的单个连接
+class PooledConnection(object):
+    __slots__ = ('conn', 'pool', 'created_at', 'last_used')
+
+    def __init__(self, conn, pool):
+        self.conn = conn
+        self.pool = pool
+        self.created_at = self.last_used = time.time()
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+# 单个db_label的线程安全连接池
+class ConnectionPool(object):
+    def __init__(self, db_label, db_config):
+        self.db_label = db_label
+        self.db_config = db_config
+        self.min_size = int(db_config.get('min_size', 1))
+        self.max_size = max(int(db_config.get('max_size', 10)), self.min_size, 1)
+        # 等待空闲连接的超时时间，None 表示一直等待
+        self.timeout = db_config.get('pool_timeout', 30)
+        # 空闲超过 max_idle_time 的连接会被回收（保留 min_size 个）
+        self.max_idle_time = db_config.get('max_idle_time', 600)
+        # 创建超过 max_lifetime 的连接在归还时关闭重建
+        self.max_lifetime = db_config.get('max_lifetime', 3600)
+        # 该时间内使用过的连接视为可用，空闲更久的连接取出时才 ping
+        self.ping_interval = db_config.get('ping_interval', 30)
+
+        self.size = 0
+        self.idle = collections.deque()
+        self.cond = threading.Condition()
+        # 因连接失效而丢弃的连接数
+        self.reconnects = 0
+        for _ in range(self.min_size):
+            self.idle.append(PooledConnection(self._connect(), self))
+            self.size += 1
+
+    def _connect(self):
+        db_config = self.db_config
+        conn = MySQLdb.connect(host=db_config.get('host', 'localhost'),
+                               port=int(db_config.get('port', 3306)),
+                               user=db_config.get('user', 'root'),
+                               passwd=db_config.get('password', ''),
+                               db=db_config.get('database', 'test'),
+                               charset=db_config.get('charset', 'utf8'))
+        conn.autocommit(Database.autocommit)
+        return conn
+
+    def _close(self, pooled):
+        self.size -= 1
+        try:
+            pooled.conn.close()
+        except MySQLdb.Error:
+            pass
+
+    def _expired(self, pooled, now):
+        return self.max_lifetime is not None and now - pooled.created_at > self.max_lifetime
+
+    # 回收空闲过久的连接，idle 左端为最久未使用的连接
+    def _evict(self, now):
+        if self.max_idle_time is None:
+            return
+        while self.idle and self.size > self.min_size and now - self.idle[0].last_used > self.max_idle_time:
+            self._close(self.idle.popleft())
+
+    # 取出连接
+    def checkout(self):
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        with self.cond:
+            while True:
+                now = time.time()
+                self._evict(now)
+                while self.idle:
+                    pooled = self.idle.pop()
+                    if self._expired(pooled, now) or not pooled.conn.open:
+                        self._close(pooled)
+                        continue
+                    return pooled
+                if self.size < self.max_size:
+                    # 先占位，在锁外建立连接
+                    self.size += 1
+                    break
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise PoolTimeoutError('Timed out waiting for a connection to database: %s' % self.db_label)
+                    self.cond.wait(remaining)
+        try:
+            return PooledConnection(self._connect(), self)
+        except Exception:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+
+    # 归还连接，discard 为 True 时直接关闭
+    def checkin(self, pooled, discard=False):
+        with self.cond:
+            now = time.time()
+            if discard or not pooled.conn.open or self._expired(pooled, now):
+                self._close(pooled)
             else:
-                self._insert()
+                pooled.last_used = now
+                self.idle.append(pooled)
+            self.cond.notify()
+
+    # 已取出未归还的连接数
+    def outstanding(self):
+        return self.size - len(self.idle)
+
+    def close(self):
+        with self.cond:
+            while self.idle:
+                self._close(self.idle.pop())
+
+
+# 当前线程在某个 db_label 上的事务，事务期间固定使用同一连接
+class Transaction(object):
+    def __init__(self, db_label, pooled, commit_every=None):
+        self.db_label = db_label
+        self.pooled = pooled
+        self.commit_every = commit_every
+        self.savepoints = []
+        self.savepoint_id = 0
+        self.statements = 0
+        self.dirty_tables = set()
+        self.broken = False
+
+    def _run(self, *args):
+        cursor = self.pooled.conn.cursor()
+        try:
+            cursor.execute(*args)
+        except MySQLdb.OperationalError as e:
+            if is_disconnect(e) or not self.pooled.conn.open:
+                self.broken = True
+            raise
+        return cursor
+
+    # 执行语句，设置 commit_every 时每 N 条语句提交一次（存在 savepoint 时延后提交）
+    def execute(self, args):
+        cursor = self._run(*args)
+        self.statements += 1
+        if self.commit_every and not self.savepoints and self.statements >= self.commit_every:
+            self.commit()
+        return cursor
+
+    def savepoint(self):
+        self.savepoint_id += 1
+        savepoint = 's%s' % self.savepoint_id
+        self._run('savepoint %s;' % savepoint)
+        self.savepoints.append(savepoint)
+        return savepoint
+
+    def release_savepoint(self, savepoint):
+        self.savepoints.remove(savepoint)
+        self._run('release savepoint %s;' % savepoint)
+
+    def rollback_savepoint(self, savepoint):
+        self.savepoints.remove(savepoint)
+        self._run('rollback to savepoint %s;' % savepoint)
+
+    def commit(self):
+        self.pooled.conn.commit()
+        self.statements = 0
+        # 提交前其他线程可能已按旧数据重新缓存，提交后再次失效
+        dirty_tables, self.dirty_tables = self.dirty_tables, set()
+        for db_table in dirty_tables:
+            invalidate_cache(self.db_label, db_table)
+
+    def rollback(self):
+        self.dirty_tables.clear()
+        try:
+            self.pooled.conn.rollback()
+        except MySQLdb.Error:
+            self.broken = True
+
+    # 恢复自动提交并归还连接
+    def close(self):
+        if not self.broken:
+            try:
+                self.pooled.conn.autocommit(Database.autocommit)
+            except MySQLdb.Error:
+                self.broken = True
+        Database.release_conn(self.db_label, self.pooled, self.broken)
+
+
+# 事务上下文管理器/装饰器，嵌套使用时内层为 savepoint
+class Atomic(object):
+    def __init__(self, db_label='default', commit_every=None):
+        self.db_label = db_label
+        self.commit_every = commit_every
+        self.savepoints = []
+
+    def __enter__(self):
+        transaction = Database.get_transaction(self.db_label)
+        if transaction is None:
+            pooled = Database.get_conn(self.db_label)
+            try:
+                pooled.conn.autocommit(False)
+            except MySQLdb.Error:
+                Database.release_conn(self.db_label, pooled, discard=True)
+                raise
+            transaction = Transaction(self.db_label, pooled, self.commit_every)
+            Database.set_transaction(self.db_label, transaction)
+            self.savepoints.append(None)
+        else:
+            self.savepoints.append(transaction.savepoint())
+        return transaction
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        transaction = Database.get_transaction(self.db_label)
+        savepoint = self.savepoints.pop()
+        if savepoint is not None:
+            if exc_type is None:
+                transaction.release_savepoint(savepoint)
+            elif not transaction.broken:
+                transaction.rollback_savepoint(savepoint)
+            return False
+
+        try:
+            if exc_type is None:
+                transaction.commit()
+            else:
+                transaction.rollback()
+        except Exception:
+            transaction.rollback()
+            raise
+        finally:
+            Database.set_transaction(self.db_label, None)
+            transaction.close()
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            with Atomic(self.db_label, self.commit_every):
+                return func(*args, **kwargs)
+        return inner
+
+
+# 一次sql执行的信息，传给执行钩子；duration（秒）、rowcount、error 在执行后设置
+class ExecuteEvent(object):
+    __slots__ = ('db_label', 'sql', 'params', 'queryset', 'readonly', 'duration', 'rowcount', 'error')
+
+    def __init__(self, db_label, sql, params, queryset, readonly):
+        self.db_label = db_label
+        self.sql = sql
+        self.params = params
+        self.queryset = queryset
+        self.readonly = readonly
+        self.duration = None
+        self.rowcount = None
+        self.error = None
+
+
+# 按 db_label 统计执行次数、行数、耗时及出错次数，作为 after 钩子注册：Database.add_hook(after=QueryStats())
+class QueryStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.reconnect_base = {}
+
+    def __call__(self, event):
+        with self.lock:
+            counter = self.counters.get(event.db_label)
+            if counter is None:
+                counter = self.counters[event.db_label] = {'queries': 0, 'rows': 0, 'time': 0.0, 'errors': 0}
+                self.reconnect_base.setdefault(event.db_label, Database.reconnect_count(event.db_label))
+            counter['queries'] += 1
+            if event.rowcount and event.rowcount > 0:
+                counter['rows'] += event.rowcount
+            counter['time'] += event.duration
+            if event.error is not None:
+                counter['errors'] += 1
+
+    # {db_label: {'queries', 'rows', 'time', 'errors', 'reconnects'}}
+    def snapshot(self):
+        with self.lock:
+            result = dict((db_label, dict(counter)) for db_label, counter in self.counters.items())
+            for db_label, counter in result.items():
+                counter['reconnects'] = Database.reconnect_count(db_label) - self.reconnect_base.get(db_label, 0)
+        return result
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.reconnect_base = {}
+
+
+# 慢查询日志：耗时不低于 threshold 秒的语句写入 logger 并保留最近 max_entries 条
+# explain 为 True 时另外执行 explain 记录 select 语句的执行计划
+class SlowQueryLog(object):
+    def __init__(self, threshold=1.0, logger=None, explain=False, max_entries=100):
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger('data_handler.slow_query')
+        self.explain = explain
+        self.entries = collections.deque(maxlen=max_entries)
+
+    def __call__(self, event):
+        if event.error is not None or event.duration < self.threshold:
+            return
+        plan = None
+        if self.explain and event.sql.lstrip()[:6].lower() == 'select':
+            try:
+                plan = Database.explain(event.db_label, event.sql, event.params)
+            except MySQLdb.Error:
+                pass
+        self.entries.append((event.db_label, event.sql, event.params, event.duration, plan))
+        self.logger.warning('slow query on %s (%.3fs, %s rows): %s %r%s', event.db_label, event.duration,
+                            event.rowcount, event.sql, event.params, '' if plan is None else ' plan: %r' % (plan,))
 
 
 # 数据库调用
 class Database():
     autocommit = True
-    conn = {}
+    pools = {}
+    # 配置了 replicas 的 db_label 对应的从库连接池
+    replica_pools = {}
+    round_robin = {}
     db_config = {}
+    local = threading.local()
+    # asyncio 接口及并发查询使用的线程池大小，需在首次使用前设置
+    executor_workers = 10
+    executor = None
+    fanout_executor = None
+    executor_lock = threading.Lock()
+    # 子进程中保留 fork 得到的连接池，避免回收时关闭与父进程共用的连接
+    forked_pools = []
+    # 执行钩子，见 add_hook
+    before_hooks = []
+    after_hooks = []
 
     @classmethod
     def connect(cls, **databases):
         for db_label, db_config in databases.items():
-            cls.conn[db_label] = MySQLdb.connect(host=db_config.get('host', 'localhost'),
-                                                 port=int(db_config.get('port', 3306)),
-                                                 user=db_config.get('user', 'root'),
-                                                 passwd=db_config.get('password', ''),
-                                                 db=db_config.get('database', 'test'),
-                                                 charset=db_config.get('charset', 'utf8'))
-            cls.conn[db_label].autocommit(cls.autocommit)
+            old_pools = [cls.pools.get(db_label)] + cls.replica_pools.pop(db_label, [])
+            cls.pools[db_label] = ConnectionPool(db_label, db_config)
+            # 从库配置继承主库配置
+            replica_pools = []
+            for replica in db_config.get('replicas') or []:
+                replica_config = dict(db_config)
+                del replica_config['replicas']
+                replica_config.update(replica)
+                replica_pools.append(ConnectionPool(db_label, replica_config))
+            if replica_pools:
+                cls.replica_pools[db_label] = replica_pools
+                cls.round_robin[db_label] = itertools.count()
+            for old_pool in old_pools:
+                if old_pool:
+                    old_pool.close()
         cls.db_config.update(databases)
 
+    # 注册执行钩子，before(event) 在执行前调用，after(event) 在执行后（包括出错时）调用，event 为 ExecuteEvent
+    # 未注册钩子时 execute 不做计时
+    @classmethod
+    def add_hook(cls, before=None, after=None):
+        if before is not None:
+            cls.before_hooks = cls.before_hooks + [before]
+        if after is not None:
+            cls.after_hooks = cls.after_hooks + [after]
+
+    @classmethod
+    def remove_hook(cls, before=None, after=None):
+        if before is not None:
+            cls.before_hooks = [hook for hook in cls.before_hooks if hook is not before]
+        if after is not None:
+            cls.after_hooks = [hook for hook in cls.after_hooks if hook is not after]
+
+    # db_label 的主库及从库连接池因失效丢弃的连接数
+    @classmethod
+    def reconnect_count(cls, db_label):
+        pools = [cls.pools.get(db_label)] + cls.replica_pools.get(db_label, [])
+        return sum(pool.reconnects for pool in pools if pool is not None)
+
+    # select 语句的执行计划，不触发执行钩子
+    @classmethod
+    def explain(cls, db_label, sql, params=None):
+        cursor = cls._execute_statement(db_label, ('explain ' + sql, params), True)
+        return cursor.fetchall()
+
+    # 进程池子进程初始化：丢弃 fork 得到的连接池、事务及线程池，按 db_config 重新连接
+    @classmethod
+    def reset_pools(cls, db_config=None):
+        db_config = dict(db_config or cls.db_config)
+        cls.forked_pools.append((cls.pools, cls.replica_pools))
+        cls.pools = {}
+        cls.replica_pools = {}
+        cls.local = threading.local()
+        cls.executor = cls.fanout_executor = None
+        cls.executor_lock = threading.Lock()
+        cls.connect(**db_config)
+
+    @classmethod
+    def get_pool(cls, db_label):
+        try:
+            return cls.pools[db_label]
+        except KeyError:
+            raise TypeError('Database not connected: %s' % db_label)
+
+    # 读操作使用的连接池：事务中及本线程写入后 read_your_writes 秒内使用主库，否则按 balance 选择从库
+    @classmethod
+    def get_read_pool(cls, db_label):
+        replica_pools = cls.replica_pools.get(db_label)
+        if not replica_pools or cls.get_transaction(db_label) is not None:
+            return cls.get_pool(db_label)
+        db_config = cls.db_config[db_label]
+        last_write = getattr(cls.local, 'last_writes', {}).get(db_label)
+        if last_write is not None and time.time() - last_write < db_config.get('read_your_writes', 1):
+            return cls.get_pool(db_label)
+
+        start = next(cls.round_robin[db_label]) % len(replica_pools)
+        if db_config.get('balance', 'round_robin') == 'least_outstanding':
+            rotated = replica_pools[start:] + replica_pools[:start]
+            return min(rotated, key=ConnectionPool.outstanding)
+        return replica_pools[start]
+
+    # 记录本线程在 db_label 上的写入时间
+    @classmethod
+    def mark_write(cls, db_label):
+        last_writes = getattr(cls.local, 'last_writes', None)
+        if last_writes is None:
+            last_writes = cls.local.last_writes = {}
+        last_writes[db_label] = time.time()
+
+    # 从连接池取得可用连接，用完需调用 release_conn 归还；readonly 时可能取得从库连接，从库不可用时使用主库
     @classmethod
-    def get_conn(cls, db_label):
-        if not cls.conn[db_label] or not cls.conn[db_label].open:
-            cls.connect(**cls.db_config)
+    def get_conn(cls, db_label, force_ping=False, readonly=False):
+        if not readonly:
+            return cls._checkout(cls.get_pool(db_label), force_ping)
+        pool = cls.get_read_pool(db_label)
         try:
-            cls.conn[db_label].ping()
+            return cls._checkout(pool, force_ping)
         except MySQLdb.OperationalError:
-            cls.connect(**cls.db_config)
-        return cls.conn[db_label]
+            if pool is cls.get_pool(db_label):
+                raise
+        return cls._checkout(cls.get_pool(db_label), force_ping)
 
     @classmethod
-    def execute(cls, db_label, *args):
-        db_conn = cls.get_conn(db_label)
-        cursor = db_conn.cursor()
-        cursor.execute(*args)
-        return cursor
+    def _checkout(cls, pool, force_ping):
+        while True:
+            pooled = pool.checkout()
+            idle_time = time.time() - pooled.last_used
+            if not force_ping and (pool.ping_interval is None or idle_time <= pool.ping_interval):
+                return pooled
+            try:
+                pooled.conn.ping()
+                return pooled
+            except MySQLdb.OperationalError:
+                # 只丢弃失效的连接，其余 db_label 不受影响
+                pool.reconnects += 1
+                pool.checkin(pooled, discard=True)
+
+    @classmethod
+    def release_conn(cls, db_label, pooled, discard=False):
+        pooled.pool.checkin(pooled, discard)
+
+    # 事务，Database.atomic('default') 可作为 with 语句或装饰器使用
+    @classmethod
+    def atomic(cls, db_label='default', commit_every=None):
+        return Atomic(db_label, commit_every)
+
+    @classmethod
+    def get_transaction(cls, db_label):
+        transactions = getattr(cls.local, 'transactions', None)
+        if not transactions:
+            return None
+        return transactions.get(db_label)
+
+    @classmethod
+    def set_transaction(cls, db_label, transaction):
+        transactions = getattr(cls.local, 'transactions', None)
+        if transactions is None:
+            transactions = cls.local.transactions = {}
+        if transaction is None:
+            transactions.pop(db_label, None)
+        else:
+            transactions[db_label] = transaction
+
+    @classmethod
+    def in_transaction(cls, db_label):
+        return cls.get_transaction(db_label) is not None
+
+    @classmethod
+    def get_executor(cls, name='executor'):
+        if getattr(cls, name) is None:
+            with cls.executor_lock:
+                if getattr(cls, name) is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    setattr(cls, name, ThreadPoolExecutor(max_workers=cls.executor_workers))
+        return getattr(cls, name)
+
+    # 并发执行多个无参函数，按顺序返回结果；第一个在当前线程执行
+    # 当前线程处于事务中或已在并发线程中时顺序执行，避免脱离事务及线程池互相等待
+    @classmethod
+    def run_concurrently(cls, funcs):
+        funcs = list(funcs)
+        if len(funcs) <= 1 or getattr(cls.local, 'transactions', None) or getattr(cls.local, 'in_fanout', False):
+            return [func() for func in funcs]
+
+        executor = cls.get_executor('fanout_executor')
+        last_writes = getattr(cls.local, 'last_writes', None)
+        if last_writes is None:
+            last_writes = cls.local.last_writes = {}
+        worker_writes = [dict(last_writes) for _ in funcs[1:]]
+        futures = [executor.submit(cls._fanout_call, func, writes) for func, writes in zip(funcs[1:], worker_writes)]
+        results = []
+        error = None
+        try:
+            results.append(funcs[0]())
+        except Exception as e:
+            error = e
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                error = error or e
+        # 并发线程中的写入合并回调用线程
+        for writes in worker_writes:
+            for db_label, write_time in writes.items():
+                if write_time > last_writes.get(db_label, 0):
+                    last_writes[db_label] = write_time
+        if error is not None:
+            raise error
+        return results
+
+    # 并发线程沿用调用线程的写入时间，保证 read_your_writes，写入记录在 last_writes 中
+    @classmethod
+    def _fanout_call(cls, func, last_writes):
+        cls.local.in_fanout = True
+        cls.local.last_writes = last_writes
+        try:
+            return func()
+        finally:
+            cls.local.in_fanout = False
+
+    # 使用不同连接并发执行多个 QuerySet 的查询并填充 select_result，总耗时取决于最慢的查询
+    @classmethod
+    def gather(cls, *querysets):
+        pending = [queryset for queryset in querysets if queryset.select_result is None]
+        cls.run_concurrently([queryset.select for queryset in pending])
+        return list(querysets)
+
+    # 在线程池中执行同步调用，返回当前事件循环的 asyncio.Future
+    # 执行线程不同，不会使用调用方的 atomic 事务及 IdentityMap
+    @classmethod
+    def run_async(cls, func, *args, **kwargs):
+        import asyncio
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(cls.get_executor(), functools.partial(func, *args, **kwargs))
+
+    # 执行完成即归还连接，返回的结果已与连接分离（见 CursorResult），事务中返回事务连接的 cursor
+    # readonly=True 的语句在连接断开时会换一个连接重试一次，事务中不重试
+    @classmethod
+    def execute(cls, db_label, *args, **kwargs):
+        readonly = kwargs.get('readonly', False)
+        if not (cls.before_hooks or cls.after_hooks):
+            return cls._execute_statement(db_label, args, readonly)
+
+        event = ExecuteEvent(db_label, args[0], args[1] if len(args) > 1 else None, kwargs.get('queryset'), readonly)
+        for hook in cls.before_hooks:
+            hook(event)
+        start = timer()
+        try:
+            cursor = cls._execute_statement(db_label, args, readonly)
+            event.rowcount = cursor.rowcount
+            return cursor
+        except Exception as e:
+            event.error = e
+            raise
+        finally:
+            event.duration = timer() - start
+            for hook in cls.after_hooks:
+                hook(event)
+
+    @classmethod
+    def _execute_statement(cls, db_label, args, readonly):
+        transaction = cls.get_transaction(db_label)
+        if transaction is not None:
+            return transaction.execute(args)
+        if not readonly and db_label in cls.replica_pools:
+            cls.mark_write(db_label)
+        try:
+            return cls._execute(db_label, args, readonly=readonly)
+        except MySQLdb.OperationalError as e:
+            if not (readonly and is_disconnect(e)):
+                raise
+        return cls._execute(db_label, args, force_ping=True, readonly=readonly)
+
+    @classmethod
+    def _execute(cls, db_label, args, force_ping=False, readonly=False):
+        pooled = cls.get_conn(db_label, force_ping, readonly)
+        broken = False
+        try:
+            cursor = pooled.conn.cursor()
+            try:
+                cursor.execute(*args)
+                return CursorResult(cursor)
+            finally:
+                cursor.close()
+        except MySQLdb.OperationalError as e:
+            broken = is_disconnect(e) or not pooled.conn.open
+            if broken:
+                pooled.pool.reconnects += 1
+            raise
+        finally:
+            cls.release_conn(db_label, pooled, broken)
+
+    # 服务端游标（SSCursor）流式读取的生成器，读完后归还连接
+    # 未读完即中止时直接关闭连接，避免读取剩余的结果集
+    # 事务中使用事务的连接，中止时需读完剩余结果才能继续使用该连接
+    # 有执行钩子时 duration 为执行及读取的耗时（不含调用方处理结果的时间），rowcount 为读取的行数
+    @classmethod
+    def stream(cls, db_label, sql, params=None, chunk_size=2000, queryset=None):
+        if not (cls.before_hooks or cls.after_hooks):
+            return cls._stream(db_label, sql, params, chunk_size)
+        return cls._instrumented_stream(db_label, sql, params, chunk_size, queryset)
+
+    @classmethod
+    def _instrumented_stream(cls, db_label, sql, params, chunk_size, queryset):
+        event = ExecuteEvent(db_label, sql, params, queryset, True)
+        for hook in cls.before_hooks:
+            hook(event)
+        event.duration = 0.0
+        event.rowcount = 0
+        rows = cls._stream(db_label, sql, params, chunk_size)
+        try:
+            while True:
+                start = timer()
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    break
+                finally:
+                    event.duration += timer() - start
+                event.rowcount += 1
+                yield row
+        except Exception as e:
+            event.error = e
+            raise
+        finally:
+            rows.close()
+            for hook in cls.after_hooks:
+                hook(event)
+
+    @classmethod
+    def _stream(cls, db_label, sql, params, chunk_size):
+        transaction = cls.get_transaction(db_label)
+        if transaction is not None:
+            cursor = transaction.pooled.conn.cursor(MySQLdb.cursors.SSCursor)
+            try:
+                cursor.execute(sql, params)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                cursor.close()
+            return
+
+        pooled = cls.get_conn(db_label, readonly=True)
+        finished = False
+        try:
+            cursor = pooled.conn.cursor(MySQLdb.cursors.SSCursor)
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+            cursor.close()
+            finished = True
+        finally:
+            cls.release_conn(db_label, pooled, discard=not finished)
 
     def __del__(self):
-        for _, conn in self.conn:
-            if conn and conn.open:
-                conn.close()
+        for pool in self.pools.values():
+            pool.close()
+        for replica_pools in self.replica_pools.values():
+            for pool in replica_pools:
+                pool.close()
+
+
+# 连接断开类错误: 2006 server has gone away, 2013 lost connection, 2055 lost connection (SSL)
+DISCONNECT_ERRORS = (2006, 2013, 2055)
+
+
+def is_disconnect(error):
+    return bool(error.args) and error.args[0] in DISCONNECT_ERRORS
 
 
 def execute_raw_sql(db_label, sql, params=None):
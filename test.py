@@ -34,6 +34,10 @@ print(test.pk)
 
 test = TestModel.objects.create(a='marry', b=3)
 
+# bulk create
+objs = TestModel.objects.bulk_create([TestModel(a='bulk', b=i) for i in range(10)], batch_size=4)
+print([obj.pk for obj in objs])
+
 filter_result = TestModel.objects.filter(Q(a='john') | Q(a='marry'), pk__gt=1).exclude(b__in=[3, 4])
 print(filter_result.query)
 print(filter_result.count())
@@ -54,11 +58,20 @@ if r:
 first = filter_result[0]
 print(first == r)
 
+# get / in_bulk
+print(TestModel.objects.get(pk=first.pk) == first)
+print(TestModel.objects.in_bulk([first.pk]))
+
 # update
 first.a = 'update'
 first.save()
 filter_result.update(b=1)
 
+# bulk update
+for obj in objs:
+    obj.b = obj.pk
+TestModel.objects.bulk_update(objs, ['b'])
+
 # execute raw sql
 results = execute_raw_sql('default', 'select b, count(*) from test where b = %s group by b;', (1,))
 for val, cnt in results: